@@ -1,17 +1,14 @@
-import inspect
+import importlib
+import json
 import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
 
-from ops.charm import CharmBase, CharmMeta
-from ops.framework import Framework
-from ops.main import _get_event_args
-from ops.model import Model, _ModelBackend
-from ops.storage import SQLiteStorage
-try:
-    from ops.jujucontext import _JujuContext
-except ImportError:
-    _JujuContext = None
-
 # NB: This module should only be imported by the charms.reactive framework
 #     detecting its entry point and loading it. When used in an operator
 #     framework charm, we don't want to have it pull in the charms.reactive
@@ -19,155 +16,1709 @@ except ImportError:
 #     installed here, they are *not* included in the dependency list in
 #     setup.py.
 from charms.reactive import (
+    clear_flag,
+    get_flags,
     is_flag_set,
     register_trigger,
     set_flag,
-    toggle_flag,
 )
 from charmhelpers.core import hookenv
 from charmhelpers.core import unitdata
 
-from pkg_resources import iter_entry_points
+# When this module started being imported, for tracing.
+_IMPORT_START = time.time_ns()
+
+
+ROLES = ('provides', 'requires', 'peers')
+REGISTRY_FILE = '.ops-reactive-interface-registry.json'
+REGISTRY_VERSION = 1
+METADATA_FILE = '.ops-reactive-interface-metadata.json'
+METADATA_VERSION = 1
+DEFERRED_KEY = 'ops_reactive_interface.deferred'
+OWNERS_KEY = 'ops_reactive_interface.owners'
+HOOK_TOOLS_FILE = '.ops-reactive-interface-hook-tools.jsonl'
+TRACE_FILE = '.ops-reactive-interface-trace.jsonl'
+RECORDING_FILE = '.ops-reactive-interface-recordings.jsonl'
+RECORDING_VERSION = 1
+
+# Hooks for which an event is emitted to the interface API classes, other
+# than the relation hooks of their endpoints.
+CHARM_EVENTS = ('upgrade-charm', 'leader-elected', 'leader-settings-changed')
+RELATION_EVENTS = ('created', 'joined', 'changed', 'departed', 'broken')
+
+# The ops framework takes a significant amount of time to import, and many
+# hooks won't end up needing it at all, so it's only imported once the charm
+# is built (or one of these names is accessed on this module).
+OPS_NAMES = ('CharmBase', 'CharmEvents', 'CharmMeta', 'Framework', 'Object',
+             'StoredState', '_get_event_args', 'Model', 'ModelError',
+             '_ModelBackend', 'NoSnapshotError', 'SQLiteStorage',
+             '_JujuContext')
+
+
+def _import_ops():
+    global CharmBase, CharmEvents, CharmMeta, Framework, Object, StoredState
+    global _get_event_args, Model
+    global ModelError, _ModelBackend, NoSnapshotError, SQLiteStorage
+    global _JujuContext
+    # Check each name, since they can be removed by patching in tests.
+    if all(name in globals() for name in OPS_NAMES):
+        return
+    with InterfaceAPIFactory._span('import_ops'):
+        from ops.charm import CharmBase, CharmEvents, CharmMeta
+        from ops.framework import Framework, Object, StoredState
+        from ops.main import _get_event_args
+        from ops.model import Model, ModelError, _ModelBackend
+        from ops.storage import NoSnapshotError, SQLiteStorage
+        try:
+            from ops.jujucontext import _JujuContext
+        except ImportError:
+            _JujuContext = None
+
+
+def __getattr__(name):
+    if name in OPS_NAMES:
+        _import_ops()
+        return globals()[name]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
 
 
 def _build_event_args(cls, event):
+    global _event_args
+    if _event_args is None:
+        _event_args = _resolve_event_args()
+    return _event_args(cls._charm, event)
+
+
+def _resolve_event_args():
+    # The signature of _get_event_args depends on the version of ops, so
+    # work out how to call it once, rather than for every event.
+    import inspect
+    _import_ops()
     sig = inspect.signature(_get_event_args)
     if sig.parameters.keys() == {"charm", "bound_event"}:
-        return _get_event_args(cls._charm, event)
+        return _get_event_args
     elif (
         _JujuContext and
         sig.parameters.keys() == {"charm", "bound_event", "juju_context"}
     ):
-        _juju_context = _JujuContext.from_dict(os.environ)
-        return _get_event_args(cls._charm, event, _juju_context)
+        def event_args(charm, event):
+            # The context has to come from the current hook's environment.
+            _juju_context = _JujuContext.from_dict(os.environ)
+            return _get_event_args(charm, event, _juju_context)
+        return event_args
     else:
         raise NotImplementedError("Unsupported signature for _get_event_args")
 
 
+_event_args = None
+
+
+def _env_flag(name):
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_int(name, default=0):
+    try:
+        return int(os.environ.get(name) or default)
+    except ValueError:
+        return default
+
+
+def _state_dir():
+    # Keep our local caches next to the unitdata DB, since that is where the
+    # reactive framework keeps the rest of the unit's state.
+    db_path = os.environ.get('UNIT_STATE_DB')
+    if not db_path:
+        db_path = os.path.join(hookenv.charm_dir(), '.unit-state.db')
+    return Path(db_path).parent
+
+
+def _handle_owner(path):
+    # Everything owned by an instance (or the charm's own events) lives under
+    # `CharmBase/{kind}[{key}]` (or `CharmBase/on`), and the framework's own
+    # state is at the top level.
+    parts = path.split('/')
+    return parts[1] if len(parts) > 1 else None
+
+
+def _prime_stored_state(obj):
+    # Stored state is loaded from the unitdata database the first time it's
+    # accessed, and the database connection can only be used from the main
+    # thread, so make sure that the stored state of an instance and any
+    # objects it owns is loaded before handing it to another thread.
+    for klass in type(obj).__mro__:
+        for name, attr in list(vars(klass).items()):
+            if isinstance(attr, StoredState):
+                getattr(obj, name)
+    for value in list(vars(obj).values()):
+        if (
+            isinstance(value, Object) and
+            value.handle is not None and
+            value.handle.parent is not None and
+            value.handle.parent.path == obj.handle.path
+        ):
+            _prime_stored_state(value)
+
+
+def _read_cache(filename, version, fingerprint):
+    # Returns the data from one of our local cache files, or None if it
+    # can't be read or is out of date.
+    try:
+        cache = json.loads((_state_dir() / filename).read_text())
+    except (OSError, ValueError):
+        return None
+    if (
+        not isinstance(cache, dict) or
+        cache.get('version') != version or
+        cache.get('fingerprint') != fingerprint
+    ):
+        return None
+    return cache
+
+
+def _write_cache(filename, cache):
+    # Write to a temporary file first so that a hook which is killed part way
+    # through can't leave a truncated cache behind.
+    path = _state_dir() / filename
+    try:
+        tmp_path = path.with_name(path.name + '.tmp')
+        tmp_path.write_text(json.dumps(cache))
+        tmp_path.replace(path)
+    except (OSError, TypeError, ValueError) as e:
+        hookenv.log('Unable to save {}: {}'.format(filename, e),
+                    hookenv.WARNING)
+
+
+def _dump_state():
+    # Everything the unit keeps between hooks: the reactive flags, the
+    # unitdata key / value store, and the stored state snapshots and deferred
+    # event notices which ops keeps in the same database.
+    import base64
+    kv = unitdata.kv()
+    state = {
+        'flags': sorted(get_flags()),
+        'kv': kv.getrange(''),
+        'snapshots': {},
+        'notices': [],
+    }
+    try:
+        snapshots = kv.conn.execute(
+            'SELECT handle, data FROM snapshot').fetchall()
+        notices = kv.conn.execute(
+            'SELECT event_path, observer_path, method_name FROM notice '
+            'ORDER BY sequence').fetchall()
+    except sqlite3.OperationalError:
+        # The charm has never been built on this unit.
+        return state
+    state['snapshots'] = {handle: base64.b64encode(data).decode('ascii')
+                          for handle, data in snapshots}
+    state['notices'] = [list(notice) for notice in notices]
+    return state
+
+
+def _versions():
+    from importlib.metadata import PackageNotFoundError, version
+    versions = {'python': sys.version.split()[0]}
+    for dist in ('ops', 'ops_reactive_interface', 'charms.reactive'):
+        try:
+            versions[dist] = version(dist)
+        except PackageNotFoundError:
+            versions[dist] = None
+    return versions
+
+
+def _metadata_fingerprint():
+    # Charm upgrades replace the metadata file, which changes its mtime.
+    try:
+        stat = os.stat(os.path.join(hookenv.charm_dir(), 'metadata.yaml'))
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _prime_metadata(metadata):
+    # The reactive framework looks up the relation types through charmhelpers
+    # in every hook, which parses the metadata file again unless it's already
+    # in charmhelpers' per-hook cache, keyed on the undecorated function.
+    func = getattr(hookenv.metadata, '__wrapped__', None)
+    if func is None or not isinstance(getattr(hookenv, 'cache', None), dict):
+        return
+    key = json.dumps((func, (), {}), sort_keys=True, default=str)
+    hookenv.cache.setdefault(key, metadata)
+
+
+def _site_fingerprint():
+    # Installing or removing a distribution adds or removes its metadata
+    # directory, which bumps the mtime of the site dir containing it. Other
+    # sys.path entries (such as the charm dir, which we write to) are ignored
+    # so that they don't invalidate the registry on every hook.
+    fingerprint = []
+    for entry in sys.path:
+        if Path(entry).name not in ('site-packages', 'dist-packages'):
+            continue
+        try:
+            fingerprint.append([entry, os.stat(entry).st_mtime_ns])
+        except OSError:
+            continue
+    return fingerprint
+
+
+def _scan_entry_points():
+    from importlib.metadata import entry_points
+    all_eps = entry_points()
+    registry = {}
+    for role in ROLES:
+        group = 'ops_reactive_interface.{}'.format(role)
+        if hasattr(all_eps, 'select'):
+            eps = all_eps.select(group=group)
+        else:
+            # Python < 3.10 returns a plain dict of groups.
+            eps = all_eps.get(group, ())
+        registry[role] = {ep.name: ep.value for ep in eps}
+    return registry
+
+
+def _load_entry_point(value):
+    # Equivalent to importlib.metadata.EntryPoint.load(), without having to
+    # import importlib.metadata (and all of its dependencies) on every hook.
+    module_name, _, attrs = value.partition(':')
+    obj = importlib.import_module(module_name.strip())
+    attrs = attrs.split('[')[0].strip()
+    for attr in filter(None, attrs.split('.')):
+        obj = getattr(obj, attr)
+    return obj
+
+
+# The following are mixed into the model backend by _create_backend(), so
+# that they can be combined without importing ops until they're needed.
+
+
+class _InstrumentedBackend:
+    # Records every hook tool invocation made through the model, along with
+    # the factory phase (and endpoint, if any) it was made in.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def _run(self, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            return super()._run(*args, **kwargs)
+        finally:
+            phase, endpoint = InterfaceAPIFactory._current_phase()
+            self.calls.append({
+                'tool': args[0],
+                'args': list(args[1:]),
+                'duration': time.monotonic() - start,
+                'phase': phase,
+                'endpoint': endpoint,
+            })
+
+    def summary(self):
+        by_phase = {}
+        for call in self.calls:
+            tools = by_phase.setdefault(call['phase'], {})
+            count, duration = tools.get(call['tool'], (0, 0.0))
+            tools[call['tool']] = (count + 1, duration + call['duration'])
+        return {
+            'calls': len(self.calls),
+            'duration': sum(call['duration'] for call in self.calls),
+            'phases': by_phase,
+        }
+
+
+class _RecordingBackend:
+    # Records the request and response of every hook tool invocation made
+    # through the model, so that the hook can be replayed offline.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorded = []
+
+    def _run(self, *args, **kwargs):
+        call = {
+            'phase': InterfaceAPIFactory._current_phase()[0],
+            'args': list(args),
+            'input': kwargs.get('input_stream'),
+            'return_output': kwargs.get('return_output', False),
+            'use_json': kwargs.get('use_json', False),
+        }
+        self.recorded.append(call)
+        try:
+            call['output'] = super()._run(*args, **kwargs)
+        except ModelError as e:
+            call['error'] = str(e)
+            raise
+        return call['output']
+
+
+class _CachingBackend:
+    # Memoizes the results of the hook tools which only read model data for
+    # the rest of the hook, dropping them when they're changed through the
+    # model.
+    READ_TOOLS = ('relation-ids', 'relation-list', 'relation-get',
+                  'config-get', 'leader-get', 'goal-state', 'network-get')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = {}
+        # Results which are being fetched in the background.
+        self.prefetching = {}
+        self.cache_stats = {'hits': 0, 'misses': 0, 'prefetched': 0,
+                            'invalidated': 0}
+
+    def _run(self, *args, **kwargs):
+        if args[0] not in self.READ_TOOLS or kwargs.get('input_stream'):
+            result = super()._run(*args, **kwargs)
+            self._invalidate(args)
+            return result
+        key = (args, kwargs.get('return_output', False),
+               kwargs.get('use_json', False))
+        if key in self.cache:
+            self.cache_stats['hits'] += 1
+        elif key in self.prefetching:
+            try:
+                self.cache[key] = self.prefetching.pop(key).result()
+                self.cache_stats['prefetched'] += 1
+            except Exception:
+                # Make the call again, so that any error is handled as usual.
+                self.cache_stats['misses'] += 1
+                self.cache[key] = super()._run(*args, **kwargs)
+        else:
+            self.cache_stats['misses'] += 1
+            self.cache[key] = super()._run(*args, **kwargs)
+        # The model will sometimes update the results in place, so the
+        # cached copy needs to be kept separate.
+        result = self.cache[key]
+        if isinstance(result, (dict, list)):
+            result = result.copy()
+        return result
+
+    def _invalidate(self, args):
+        tool = args[0]
+        if tool == 'relation-set':
+            relation_id = args[args.index('-r') + 1]
+            member = self.app_name if '--app' in args else self.unit_name
+            stale = [key for key in self.cache
+                     if key[0][:5] == ('relation-get', '-r', relation_id,
+                                       '-', member)]
+        elif tool == 'leader-set':
+            stale = [key for key in self.cache if key[0][0] == 'leader-get']
+        else:
+            return
+        for key in stale:
+            del self.cache[key]
+        self.cache_stats['invalidated'] += len(stale)
+
+    def prefetch(self, calls):
+        # Start running the given hook tool calls in background threads, so
+        # that they are (hopefully) already done by the time the results are
+        # needed.
+        from concurrent.futures import ThreadPoolExecutor
+        run = super()._run
+
+        def fetch(args):
+            InterfaceAPIFactory._worker_phase.value = ('prefetch', None)
+            return run(*args, return_output=True, use_json=True)
+
+        calls = [tuple(args) for args in calls
+                 if (tuple(args), True, True) not in self.cache]
+        if not calls:
+            return
+        pool = ThreadPoolExecutor(max_workers=len(calls))
+        for args in calls:
+            self.prefetching[(args, True, True)] = pool.submit(fetch, args)
+        pool.shutdown(wait=False)
+
+    def hit_rate(self):
+        hits = self.cache_stats['hits'] + self.cache_stats['prefetched']
+        total = hits + self.cache_stats['misses']
+        return hits / total if total else 0.0
+
+
+class _BufferedBackend:
+    # Holds relation data writes until the end of the hook, merging repeated
+    # writes to the same bag, and then writes each bag at once. Reads of our
+    # own bags include the pending writes.
+
+    def __init__(self, *args, **kwargs):
+        import inspect
+        super().__init__(*args, **kwargs)
+        # Older versions of ops can't pass the data to relation-set on stdin,
+        # so the keys have to be written one at a time.
+        self.use_file = 'input_stream' in inspect.signature(
+            _ModelBackend._run).parameters
+        self.pending = {}
+        self.write_stats = {'writes': 0, 'relation_sets': 0}
+
+    def relation_set(self, relation_id, key, value, is_app):
+        # Make the same checks as ops does for a direct write, so that a
+        # write which can't be made still fails straight away.
+        if not isinstance(is_app, bool):
+            raise TypeError('is_app parameter to relation_set must be a '
+                            'boolean')
+        if is_app and not self._juju_version().has_app_data():
+            raise RuntimeError('setting application data is not supported on '
+                               'Juju version {}'.format(self._juju_version()))
+        self.pending.setdefault((relation_id, is_app), {})[key] = value
+        self.write_stats['writes'] += 1
+
+    def _juju_version(self):
+        # Older versions of ops take the Juju version from the environment.
+        context = getattr(self, '_juju_context', None)
+        if context is not None:
+            return context.version
+        from ops.jujuversion import JujuVersion
+        return JujuVersion.from_environ()
+
+    def relation_get(self, relation_id, member_name, is_app):
+        data = super().relation_get(relation_id, member_name, is_app)
+        own_name = self.app_name if is_app else self.unit_name
+        pending = self.pending.get((relation_id, is_app))
+        if member_name != own_name or not pending:
+            return data
+        data = dict(data)
+        for key, value in pending.items():
+            # Setting a key to an empty value removes it.
+            if value == '':
+                data.pop(key, None)
+            else:
+                data[key] = value
+        return data
+
+    def flush(self):
+        from ops.model import RelationNotFoundError
+        pending, self.pending = self.pending, {}
+        for (relation_id, is_app), data in sorted(pending.items()):
+            try:
+                self._write_bag(relation_id, data, is_app)
+            except ModelError as e:
+                # The relation may have been removed since it was written to,
+                # in which case there's nowhere left to write the data. A
+                # direct write would have failed, but by the end of the hook
+                # it's too late for the charm to handle that.
+                if not (isinstance(e, RelationNotFoundError) or
+                        self._is_relation_not_found(e)):
+                    raise
+                hookenv.log('ops_reactive_interface: dropped buffered writes '
+                            'of {} to relation {}, which no longer '
+                            'exists'.format(', '.join(sorted(data)),
+                                            relation_id),
+                            hookenv.WARNING)
+
+    def _write_bag(self, relation_id, data, is_app):
+        import yaml
+        if not self.use_file:
+            for key, value in data.items():
+                super().relation_set(relation_id, key, value, is_app)
+                self.write_stats['relation_sets'] += 1
+            return
+        args = ['relation-set', '-r', str(relation_id)]
+        if is_app:
+            args.append('--app')
+        args.extend(['--file', '-'])
+        self._run(*args, input_stream=yaml.safe_dump(data))
+        self.write_stats['relation_sets'] += 1
+
+
+class _TrackedStorage:
+    # Wraps the ops storage which shares the unitdata connection, so that
+    # snapshots are only written if they actually changed during the hook,
+    # and are then all written at once when the framework commits. The final
+    # database commit is left to the reactive framework.
+
+    def __init__(self, storage):
+        _import_ops()
+        self._storage = storage
+        self._db = storage._db
+        # The pickled data of each snapshot as it was loaded (or None if it
+        # didn't exist), and as it was saved (or None if it was dropped).
+        self._loaded = {}
+        self._pending = {}
+        self.stats = {'rows': 0, 'bytes': 0, 'unchanged': 0}
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def load_snapshot(self, handle_path):
+        import pickle
+        if handle_path in self._pending:
+            raw_data = self._pending[handle_path]
+        else:
+            row = self._db.execute('SELECT data FROM snapshot WHERE handle=?',
+                                   (handle_path,)).fetchone()
+            raw_data = bytes(row[0]) if row else None
+            self._loaded[handle_path] = raw_data
+        if raw_data is None:
+            raise NoSnapshotError(handle_path)
+        return pickle.loads(raw_data)
+
+    def save_snapshot(self, handle_path, snapshot_data):
+        import pickle
+        self._pending[handle_path] = pickle.dumps(snapshot_data)
+
+    def drop_snapshot(self, handle_path):
+        self._pending[handle_path] = None
+
+    def list_snapshots(self):
+        self.flush()
+        return self._storage.list_snapshots()
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        unknown = [handle_path for handle_path in pending
+                   if handle_path not in self._loaded]
+        if unknown:
+            rows = self._db.execute(
+                'SELECT handle, data FROM snapshot WHERE handle IN ({})'
+                .format(', '.join('?' * len(unknown))), unknown)
+            self._loaded.update(dict.fromkeys(unknown))
+            self._loaded.update((handle_path, bytes(raw_data))
+                                for handle_path, raw_data in rows)
+        saved = []
+        dropped = []
+        for handle_path, raw_data in pending.items():
+            if raw_data == self._loaded[handle_path]:
+                self.stats['unchanged'] += 1
+            elif raw_data is None:
+                dropped.append((handle_path,))
+            else:
+                saved.append((handle_path, raw_data))
+                self.stats['bytes'] += len(raw_data)
+            self._loaded[handle_path] = raw_data
+        if saved:
+            self._db.executemany('REPLACE INTO snapshot VALUES (?, ?)', saved)
+        if dropped:
+            self._db.executemany('DELETE FROM snapshot WHERE handle=?',
+                                 dropped)
+        self.stats['rows'] += len(saved) + len(dropped)
+
+    def commit(self):
+        self.flush()
+
+    def close(self):
+        pass
+
+
 class InterfaceAPIFactory:
+    # When lazy, load() only records which class is bound to each endpoint
+    # and the instances are created the first time they are needed.
+    lazy = _env_flag('ORI_LAZY')
+    # When instrumented, all hook tool calls made through the model are
+    # recorded and summarized at the end of the hook.
+    instrument = _env_flag('ORI_INSTRUMENT')
+    # When cached, the results of hook tools which read model data are
+    # reused for the rest of the hook, until they're changed via the model.
+    cache = _env_flag('ORI_CACHE')
+    # When prefetching (which implies caching), the remote relation data for
+    # a relation hook is fetched in the background during startup.
+    prefetch = _env_flag('ORI_PREFETCH')
+    # When buffered, relation data writes are held until the end of the hook
+    # and each bag is written with a single relation-set.
+    buffer_writes = _env_flag('ORI_BUFFER_WRITES')
+    # With the fast path, hooks which have no work for the interface API
+    # classes (no deferred events, no relation hook for a bound endpoint, and
+    # not upgrade-charm or leader-elected) skip building the charm and
+    # managing the flags. The charm is then only built if an instance is
+    # requested.
+    fast_path = _env_flag('ORI_FAST_PATH')
+    # When tracing, spans for each phase of the hook are written to a local
+    # file in the OpenTelemetry (OTLP) JSON format.
+    trace = _env_flag('ORI_TRACE')
+    # Maximum number of threads to use to gather the flags for the endpoints
+    # whose classes support it (0 to always gather them one at a time).
+    flag_workers = _env_int('ORI_FLAG_WORKERS')
+    # Drop deferred notices which duplicate an earlier one for the same
+    # observer, event type and event data before re-emitting them.
+    coalesce_deferred = _env_flag('ORI_COALESCE_DEFERRED')
+    # Maximum number of deferred events to re-emit per hook (0 for no limit).
+    reemit_limit = _env_int('ORI_REEMIT_LIMIT')
+    # When recording, the environment, every hook tool call and its result,
+    # and the unit's state before and after the hook are written to a local
+    # file, so that the hook can be replayed offline.
+    record = _env_flag('ORI_RECORD')
+
+    # Counts of registered entry points scanned, classes imported, and
+    # instances created, for the current hook.
+    load_stats = {'entry_points': 0, 'classes': 0, 'instances': 0}
+    # Counts of automatic flags which were changed or skipped because they
+    # already had the right value, for the current hook.
+    flag_stats = {'changed': 0, 'skipped': 0}
+    # Size of the deferred event queue, how many were coalesced or re-emitted,
+    # and how long the oldest has been waiting (in seconds), for the current
+    # hook.
+    deferred_stats = {'pending': 0, 'coalesced': 0, 'reemitted': 0,
+                      'oldest_age': None}
+    # Counts of cached hook tool results which were reused, fetched, fetched
+    # in the background, and dropped because they were changed, for the
+    # current hook.
+    cache_stats = {'hits': 0, 'misses': 0, 'prefetched': 0,
+                   'invalidated': 0}
+    # Counts of the stored state rows written (or deleted) and bytes written,
+    # and of the snapshots which were saved without changing, for the current
+    # hook.
+    storage_stats = {'rows': 0, 'bytes': 0, 'unchanged': 0}
+    # Counts of buffered relation data writes, and of the relation-set calls
+    # used to flush them, for the current hook.
+    write_stats = {'writes': 0, 'relation_sets': 0}
+
+    _bindings = {}
+    _classes = {}
+    _registered = False
+    # When the current hook started, which for the first hook in a process
+    # is when this module was imported.
+    _hook_start = _IMPORT_START
     _relation_apis = {}
     _charm = None
+    _metadata = None
+    _idle = False
+    _registry = None
+    _topology = {}
+    _backend = None
+    _phase = (None, None)
+    _worker_phase = threading.local()
+    _interfaces = {}
+    _spans = []
+    _span_stack = threading.local()
+    _dispatch_start = None
+    _pending_flags = {}
+    _changed_triggers = {}
+    _recording = None
+    _flag_index = {}
+    _flag_prefixes = {}
+    _dispatch = {}
+
+    @classmethod
+    @contextmanager
+    def _in_phase(cls, phase, endpoint=None):
+        previous = cls._phase
+        cls._phase = (phase, endpoint)
+        try:
+            with cls._span(phase, endpoint=endpoint):
+                yield
+        finally:
+            cls._phase = previous
+
+    @classmethod
+    @contextmanager
+    def _span(cls, name, endpoint=None, **attributes):
+        # Records a trace span, if tracing. Spans are nested within the
+        # current span of the same thread.
+        if not cls.trace:
+            yield
+            return
+        if endpoint is not None:
+            attributes['juju.endpoint'] = endpoint
+            if endpoint in cls._interfaces:
+                attributes['juju.interface'] = cls._interfaces[endpoint]
+        stack = cls._span_stack.__dict__.setdefault('spans', [])
+        span = {
+            'name': name,
+            'spanId': os.urandom(8).hex(),
+            'parentSpanId': stack[-1]['spanId'] if stack else '',
+            'start': time.time_ns(),
+            'attributes': attributes,
+        }
+        stack.append(span)
+        try:
+            yield
+        finally:
+            stack.pop()
+            span['end'] = time.time_ns()
+            cls._spans.append(span)
+
+    @classmethod
+    def _current_phase(cls):
+        # Worker threads track their own phase, separately from the main
+        # thread.
+        return getattr(cls._worker_phase, 'value', None) or cls._phase
 
     @classmethod
     def load(cls):
+        if cls.record and cls._recording is None:
+            cls._recording = {'start': time.time(), 'before': _dump_state()}
+        with cls._in_phase('load'):
+            return cls._load()
+
+    @classmethod
+    def _load(cls):
+        cls.load_stats = dict.fromkeys(cls.load_stats, 0)
+        meta = cls._get_metadata()
+        try:
+            bindings = cls._resolve(meta, cls._get_registry())
+        except (ImportError, AttributeError):
+            # A cached entry point which can no longer be loaded means the
+            # installed distributions changed in a way the fingerprint didn't
+            # catch, so rescan once before giving up.
+            if cls._registry.get('scanned'):
+                raise
+            cls.load_stats = dict.fromkeys(cls.load_stats, 0)
+            bindings = cls._resolve(meta, cls._get_registry(refresh=True))
+        cls._bindings.update(bindings)
+        cls._index_flags()
+        cls._build_dispatch()
+        cls._record_owners()
+        cls._idle = cls.fast_path and not cls._has_work()
+        # The prefetch has to start before any instance is built, since
+        # building the first one builds the charm (and its backend).
+        if cls.prefetch and not cls._idle and cls._charm is None:
+            cls._prefetch()
+        if not (cls.lazy or cls._idle):
+            for endpoint_name in bindings:
+                cls._build(endpoint_name)
+        return cls.load_stats
+
+    @classmethod
+    def _get_metadata(cls):
+        # Parsing the metadata YAML is slow, so it's cached as JSON and only
+        # parsed again when the charm is upgraded or the file changes. The
+        # cached copy is also handed to charmhelpers, so that the reactive
+        # framework doesn't parse the file itself later in the hook.
+        if cls._metadata is not None:
+            return cls._metadata
+        fingerprint = _metadata_fingerprint()
+        if fingerprint is not None and hookenv.hook_name() != 'upgrade-charm':
+            cache = _read_cache(METADATA_FILE, METADATA_VERSION, fingerprint)
+            if cache is not None:
+                cls._metadata = cache['metadata']
+                _prime_metadata(cls._metadata)
+                return cls._metadata
+        cls._metadata = hookenv.metadata()
+        if fingerprint is not None:
+            _write_cache(METADATA_FILE, {
+                'version': METADATA_VERSION,
+                'fingerprint': fingerprint,
+                'metadata': cls._metadata,
+            })
+        return cls._metadata
+
+    @classmethod
+    def _has_work(cls):
+        # This has to be answered without building the charm, so the hook
+        # name and the storage are checked directly.
+        if hookenv.hook_name() in cls._dispatch:
+            return True
+        return cls._has_notices()
+
+    @classmethod
+    def _has_notices(cls):
+        try:
+            cursor = unitdata.kv().conn.execute(
+                'SELECT 1 FROM notice LIMIT 1')
+        except sqlite3.OperationalError:
+            # The table is created along with the first framework.
+            return False
+        return cursor.fetchone() is not None
+
+    @classmethod
+    def _resolve(cls, meta, registry):
+        bindings = {}
+        # Classes are kept for the life of the process, so that they're only
+        # imported once when running many hooks.
+        classes = cls._classes
+        for role in ROLES:
+            # Index the endpoints by interface in a single pass, so that each
+            # registered class is only imported once and then bound to all of
+            # the endpoints which use its interface.
+            by_interface = {}
+            role_meta = meta.get(role) or {}
+            for endpoint_name, endpoint_meta in role_meta.items():
+                endpoints = by_interface.setdefault(
+                    endpoint_meta['interface'], [])
+                endpoints.append(endpoint_name)
+                cls._interfaces[endpoint_name] = endpoint_meta['interface']
+            for interface_name, ep_value in registry[role].items():
+                cls.load_stats['entry_points'] += 1
+                if interface_name not in by_interface:
+                    continue
+                if ep_value not in classes:
+                    with cls._span('load_class', **{
+                        'juju.interface': interface_name,
+                        'ori.entry_point': ep_value,
+                    }):
+                        classes[ep_value] = _load_entry_point(ep_value)
+                    cls.load_stats['classes'] += 1
+                for endpoint_name in by_interface[interface_name]:
+                    bindings[endpoint_name] = classes[ep_value]
+        return bindings
+
+    @classmethod
+    def _get_registry(cls, refresh=False):
+        # The registry maps each role to the interface names and entry point
+        # values registered for it. Scanning the installed distributions for
+        # those is slow, so the result is cached on disk and only rebuilt when
+        # the charm is upgraded or the installed distributions change.
+        if cls._registry is not None and not refresh:
+            return cls._registry['entry_points']
+        fingerprint = _site_fingerprint()
+        if not refresh and hookenv.hook_name() != 'upgrade-charm':
+            registry = _read_cache(REGISTRY_FILE, REGISTRY_VERSION,
+                                   fingerprint)
+            if registry is not None:
+                cls._registry = registry
+                return registry['entry_points']
+        registry = {
+            'version': REGISTRY_VERSION,
+            'fingerprint': fingerprint,
+            'entry_points': _scan_entry_points(),
+        }
+        _write_cache(REGISTRY_FILE, registry)
+        cls._registry = dict(registry, scanned=True)
+        return registry['entry_points']
+
+    @classmethod
+    def _build(cls, endpoint_name):
+        rel_api_class = cls._bindings[endpoint_name]
         charm = cls._create_charm()
-        for role in ('provides', 'requires', 'peers'):
-            role_endpoints = getattr(charm.meta, role)
-            entry_point = 'ops_reactive_interface.{}'.format(role)
-            for ep in iter_entry_points(entry_point):
-                interface_name = ep.name
-                for endpoint_name, endpoint_meta in role_endpoints.items():
-                    if endpoint_meta.interface_name == interface_name:
-                        rel_api_class = ep.load()
-                        rel_api_inst = rel_api_class(charm, endpoint_name)
-                        cls._relation_apis[endpoint_name] = rel_api_inst
+        with cls._span('build', endpoint=endpoint_name,
+                       **{'ori.class': rel_api_class.__name__}):
+            rel_api_inst = rel_api_class(charm, endpoint_name)
+        cls._relation_apis[endpoint_name] = rel_api_inst
+        cls.load_stats['instances'] += 1
+        return rel_api_inst
+
+    @classmethod
+    def _has_api(cls, endpoint_name, attr):
+        # Avoid building an instance just to check for an attribute, which
+        # means that it has to be defined on the class. Checking the class of
+        # an existing instance, too, means that properties such as is_changed
+        # aren't evaluated just to find out whether they exist.
+        if endpoint_name in cls._relation_apis:
+            return hasattr(type(cls._relation_apis[endpoint_name]), attr)
+        return hasattr(cls._bindings[endpoint_name], attr)
+
+    @classmethod
+    def _eager_endpoints(cls):
+        # Even in lazy mode, some instances have to exist before events are
+        # emitted so that they can observe them:
+        #  * all of them for the charm-wide events, such as upgrade-charm
+        #  * the endpoint for the current relation hook
+        #  * the owners of any deferred notices, or everything if a notice
+        #    can't be attributed to an endpoint, since ops will drop notices
+        #    whose observer doesn't exist or whose event type isn't known
+        endpoints = set()
+        hook_name = hookenv.hook_name()
+        if hook_name in cls._dispatch:
+            relation_name = cls._dispatch[hook_name][1]
+            if relation_name is None:
+                return set(cls._bindings)
+            endpoints.add(relation_name)
+        store = cls._charm.framework._storage
+        for event_path, observer_path, _ in store.notices():
+            observer_endpoint = cls._endpoint_from_path(observer_path)
+            if observer_endpoint is None:
+                return set(cls._bindings)
+            endpoints.add(observer_endpoint)
+            event_endpoint = cls._endpoint_from_path(event_path)
+            if event_endpoint is not None:
+                endpoints.add(event_endpoint)
+        return endpoints
+
+    @classmethod
+    def _endpoint_from_path(cls, path):
+        # Instances are created with the endpoint name as their handle key,
+        # so everything they own lives under `CharmBase/{kind}[{endpoint}]`.
+        parts = path.split('/')
+        if len(parts) < 2 or not parts[1].endswith(']'):
+            return None
+        key = parts[1][:-1].partition('[')[2]
+        if key not in cls._bindings:
+            return None
+        return key
+
+    @classmethod
+    def _owners(cls):
+        return {'{}[{}]'.format(api_class.handle_kind, endpoint_name)
+                for endpoint_name, api_class in cls._bindings.items()}
+
+    @classmethod
+    def _record_owners(cls):
+        # Remember every instance that has been bound since the stored state
+        # was last cleaned, so that any which go away can be cleaned up.
+        kv = unitdata.kv()
+        owners = set(kv.get(OWNERS_KEY) or ()) | cls._owners()
+        kv.set(OWNERS_KEY, sorted(owners))
+
+    @classmethod
+    def stored_state_footprint(cls):
+        # Returns the number of snapshots and notices, and the total size of
+        # the snapshots, by the owner of their handles. That is the instance
+        # (e.g., `ORITest[give]`), `on` for the charm's events, or None for
+        # the framework itself.
+        store = cls._create_charm().framework._storage
+        if isinstance(store, _TrackedStorage):
+            store.flush()
+        footprint = {}
+
+        def usage(owner):
+            return footprint.setdefault(
+                owner, {'snapshots': 0, 'notices': 0, 'bytes': 0})
+
+        for handle_path, size in store._db.execute(
+                'SELECT handle, length(data) FROM snapshot'):
+            owner_usage = usage(_handle_owner(handle_path))
+            owner_usage['snapshots'] += 1
+            owner_usage['bytes'] += size or 0
+        for _, observer_path, _ in store.notices():
+            usage(_handle_owner(observer_path))['notices'] += 1
+        return footprint
+
+    @classmethod
+    def clean_stored_state(cls):
+        # Delete the snapshots and notices of the instances which were bound
+        # in previous hooks but no longer are, such as for endpoints which
+        # were removed or classes which were replaced in a charm upgrade.
+        # Only handles belonging to instances which this factory created are
+        # touched.
+        kv = unitdata.kv()
+        current = cls._owners()
+        stale = set(kv.get(OWNERS_KEY) or ()) - current
+        removed = {'snapshots': 0, 'notices': 0, 'bytes': 0}
+        if stale:
+            store = cls._create_charm().framework._storage
+            if isinstance(store, _TrackedStorage):
+                store.flush()
+            sizes = dict(store._db.execute(
+                'SELECT handle, length(data) FROM snapshot'))
+            dropped_events = set()
+            kept_events = set()
+            for notice in list(store.notices()):
+                event_path, observer_path, _ = notice
+                if {_handle_owner(event_path),
+                        _handle_owner(observer_path)} & stale:
+                    store.drop_notice(*notice)
+                    dropped_events.add(event_path)
+                    removed['notices'] += 1
+                else:
+                    kept_events.add(event_path)
+            for handle_path in sizes:
+                if (
+                    _handle_owner(handle_path) in stale or
+                    handle_path in dropped_events - kept_events
+                ):
+                    store.drop_snapshot(handle_path)
+                    removed['snapshots'] += 1
+                    removed['bytes'] += sizes[handle_path] or 0
+            hookenv.log('Removed {snapshots} snapshots ({bytes} bytes) and '
+                        '{notices} notices for {owners}'.format(
+                            owners=', '.join(sorted(stale)), **removed),
+                        hookenv.INFO)
+        kv.set(OWNERS_KEY, sorted(current))
+        return removed
+
+    @classmethod
+    def topology(cls, endpoint_name):
+        # Returns a tuple of (relation ID, related unit count) pairs for the
+        # endpoint. These come from a snapshot which is taken for all bound
+        # endpoints at startup and then shared with the API instances via the
+        # model's relation cache. If the model's cached relations have been
+        # invalidated since (e.g., by the hook changing the model), the
+        # endpoint's snapshot is refreshed.
+        relations = cls._create_charm().model.relations[endpoint_name]
+        snapshot = cls._topology.get(endpoint_name)
+        if snapshot is None or snapshot[0] is not relations:
+            snapshot = (relations, tuple((relation.id, len(relation.units))
+                                         for relation in relations))
+            cls._topology[endpoint_name] = snapshot
+        return snapshot[1]
+
+    @classmethod
+    def relation_count(cls, endpoint_name):
+        # Number of relations on the endpoint, from the topology snapshot.
+        return len(cls.topology(endpoint_name))
+
+    @classmethod
+    def unit_count(cls, endpoint_name):
+        # Number of related units across all of the endpoint's relations,
+        # from the topology snapshot.
+        return sum(num_units for _, num_units in cls.topology(endpoint_name))
+
+    @classmethod
+    def _snapshot_topology(cls):
+        cls._topology = {}
+        for endpoint_name in cls._bindings:
+            cls.topology(endpoint_name)
 
     @classmethod
     def from_name(cls, relation_name):
-        return cls._relation_apis.get(relation_name)
+        if relation_name in cls._relation_apis:
+            return cls._relation_apis[relation_name]
+        if relation_name not in cls._bindings:
+            return None
+        return cls._build(relation_name)
+
+    @classmethod
+    def _index_flags(cls):
+        # Reactive handlers look up instances by flag constantly, so map each
+        # flag known to belong to an endpoint, and each flag prefix used by
+        # an endpoint, to that endpoint up front. Classes can list any other
+        # flags they manage in `managed_flags`, and any other prefixes they
+        # use in `flag_prefixes`, using `{relation_name}` as a placeholder.
+        index = {}
+        prefixes = {}
+        for relation_name, api_class in cls._bindings.items():
+            # A bare endpoint.{relation_name} flag also names its endpoint.
+            flags = ['endpoint.{relation_name}']
+            flags.extend('endpoint.{relation_name}.' + name
+                         for name in ('created', 'joined', 'changed'))
+            flags.extend(getattr(api_class, 'managed_flags', ()))
+            for flag in flags:
+                index[flag.format(relation_name=relation_name)] = (
+                    relation_name)
+            for prefix in ('endpoint.{relation_name}.', '{relation_name}.',
+                           *getattr(api_class, 'flag_prefixes', ())):
+                prefixes[prefix.format(relation_name=relation_name)] = (
+                    relation_name)
+        cls._flag_index = index
+        cls._flag_prefixes = prefixes
+
+    @classmethod
+    def _endpoint_from_flag(cls, flag):
+        try:
+            return cls._flag_index[flag]
+        except KeyError:
+            pass
+        # Match the longest known prefix, and remember the result (even if
+        # there's no match) so that the next lookup is a single dict access.
+        relation_name = None
+        end = len(flag)
+        while relation_name is None and end > 0:
+            end = flag.rfind('.', 0, end)
+            relation_name = cls._flag_prefixes.get(flag[:end + 1])
+        cls._flag_index[flag] = relation_name
+        return relation_name
 
     @classmethod
     def from_flag(cls, flag):
-        if not is_flag_set(flag) or '.' not in flag:
+        # Unknown flags can't belong to an instance, so there's no need to
+        # check whether they're set.
+        relation_name = cls._endpoint_from_flag(flag)
+        if relation_name is None or not is_flag_set(flag):
             return None
-        parts = flag.split('.')
-        if parts[0] == 'endpoint':
-            return cls.from_name(parts[1])
-        else:
-            return cls.from_name(parts[0])
+        return cls.from_name(relation_name)
 
     @classmethod
     def _create_charm(cls):
+        _import_ops()
         if cls._charm is None:
-            charm_dir = Path(hookenv.charm_dir())
-            # Both unitdata and SQLiteStorage want to use the same local file,
-            # and they both try to open and lock it when the class is created.
-            # To make sure we handle charm upgrades gracefully, we want to
-            # force the ops store instance to share the existing connection.
-            # We also need to defer to the reactive framework to do the final
-            # database commit & close, so we patch those out with a no-op.
-            store = SQLiteStorage(':memory:')
-            store.close()
-            store._db = unitdata.kv().conn
-            store._setup()
-            store.commit = lambda: None
-            store.close = lambda: None
-
-            meta = CharmMeta(hookenv.metadata())
-            model = Model(meta, _ModelBackend())
-            framework = Framework(store, charm_dir, meta, model)
-            framework.set_breakpointhook()
-            cls._charm = CharmBase(framework)
+            with cls._span('create_charm'):
+                cls._charm = cls._build_charm()
         return cls._charm
 
+    @classmethod
+    def _build_charm(cls):
+        charm_dir = Path(hookenv.charm_dir())
+        # Both unitdata and SQLiteStorage want to use the same local file,
+        # and they both try to open and lock it when the class is created.
+        # To make sure we handle charm upgrades gracefully, we want to
+        # force the ops store instance to share the existing connection.
+        # We also need to defer to the reactive framework to do the final
+        # database commit & close, which the tracked storage leaves alone.
+        store = SQLiteStorage(':memory:')
+        store.close()
+        store._db = unitdata.kv().conn
+        store._setup()
+        store = _TrackedStorage(store)
+        cls.storage_stats = store.stats
+
+        meta = CharmMeta(cls._get_metadata())
+        if cls._backend is None:
+            cls._backend = cls._create_backend()
+        if isinstance(cls._backend, _CachingBackend):
+            cls.cache_stats = cls._backend.cache_stats
+        if isinstance(cls._backend, _BufferedBackend):
+            cls.write_stats = cls._backend.write_stats
+        model = Model(meta, cls._backend)
+        framework = Framework(store, charm_dir, meta, model)
+        framework.set_breakpointhook()
+        # The relation events are defined on the charm's events class when
+        # the charm is created, and can't be defined twice, so each charm
+        # gets its own classes (with the same name, to keep the same handle
+        # paths).
+        charm_class = type('CharmBase', (CharmBase,), {
+            'on': type('CharmEvents', (CharmEvents,), {})(),
+        })
+        return charm_class(framework)
+
+    @classmethod
+    def _create_backend(cls):
+        backend_classes = []
+        # The write buffer sits in front of the cache, so that reads still go
+        # through it, and the cache goes in front of the instrumentation so
+        # that only the calls which actually invoke a hook tool are counted
+        # (or recorded).
+        if cls.buffer_writes:
+            backend_classes.append(_BufferedBackend)
+        if cls.cache or cls.prefetch:
+            backend_classes.append(_CachingBackend)
+        if cls.instrument:
+            backend_classes.append(_InstrumentedBackend)
+        if cls.record:
+            backend_classes.append(_RecordingBackend)
+        if not backend_classes:
+            return _ModelBackend()
+        backend_classes.append(_ModelBackend)
+        return type('_Backend', tuple(backend_classes), {})()
+
+    @classmethod
+    def register(cls):
+        # Hook into the start and end of the reactive framework's handling of
+        # a hook. This is done when this module is imported, but has to be
+        # done again for each hook when running many in the same process,
+        # since the callbacks are discarded once they've been run.
+        if cls._registered:
+            return
+        # If a handler raised and aborted the last hook, its shutdown is still
+        # pending (charmhelpers only drops the callbacks once they've run), so
+        # it mustn't be added a second time.
+        pending = [callback for callback, _, _ in
+                   (*hookenv._atstart, *hookenv._atexit)]
+        if cls._startup not in pending:
+            hookenv.atstart(cls._startup)
+        if cls._shutdown not in pending:
+            hookenv.atexit(cls._shutdown)
+        cls._registered = True
+
+    @classmethod
+    def create_context(cls):
+        # Prepare to run another hook in the same process, before the
+        # reactive framework loads the relation factories for it.
+        cls.reset()
+        cls.register()
+
+    @classmethod
+    @contextmanager
+    def context(cls):
+        cls.create_context()
+        try:
+            yield cls
+        finally:
+            cls.reset()
+
+    @classmethod
+    def reset(cls):
+        # Drop all of the state for the current hook. The registry and any
+        # interface API classes which have been imported are kept, since
+        # they're reused by the next hook (and refreshed if they change), as
+        # are the .changed triggers, which the reactive framework keeps for
+        # as long as the process.
+        # Whether the startup and shutdown were registered is dropped too,
+        # since the shutdown never runs (and so can't clear it) if a handler
+        # raises and aborts the hook; registering again then only adds the
+        # callbacks which are no longer pending.
+        cls._registered = False
+        cls._hook_start = time.time_ns()
+        cls._bindings = {}
+        cls._relation_apis = {}
+        cls._charm = None
+        cls._metadata = None
+        cls._idle = False
+        cls._topology = {}
+        cls._backend = None
+        cls._phase = (None, None)
+        cls._interfaces = {}
+        cls._spans = []
+        cls._dispatch_start = None
+        cls._pending_flags = {}
+        cls._recording = None
+        cls._flag_index = {}
+        cls._flag_prefixes = {}
+        cls._dispatch = {}
+        for stats in ('load_stats', 'flag_stats', 'cache_stats',
+                      'storage_stats', 'write_stats'):
+            setattr(cls, stats, dict.fromkeys(getattr(cls, stats), 0))
+        cls.deferred_stats = dict.fromkeys(cls.deferred_stats, 0)
+        cls.deferred_stats['oldest_age'] = None
+
+    @classmethod
+    def dispose(cls):
+        # Drop everything, including the registry and imported classes, as if
+        # this module had never been loaded. The .changed triggers are still
+        # kept, since they can't be removed from the reactive framework.
+        cls.reset()
+        cls._registry = None
+        cls._classes = {}
+
     @classmethod
     def _startup(cls):
+        if cls._idle:
+            # Nothing can have changed the automatic flags, but the reactive
+            # handlers may still clear the changed flags.
+            for relation_name in cls._bindings:
+                if cls._has_api(relation_name, 'is_changed'):
+                    cls._register_changed_trigger(relation_name)
+            cls._start_dispatch()
+            return
+        with cls._in_phase('startup'):
+            cls._create_charm()
+            if cls.lazy:
+                for endpoint_name in cls._eager_endpoints():
+                    cls.from_name(endpoint_name)
+            cls._snapshot_topology()
+        # Instances stop being bound when a charm upgrade changes the
+        # interface of their endpoint or removes it. The relation-broken
+        # hooks are a regular point to catch anything left over, too.
+        hook_name = hookenv.hook_name()
+        relation_name = cls._dispatch.get(hook_name, (None, None))[1]
+        if hook_name in ('upgrade-charm',
+                         '{}-relation-broken'.format(relation_name)):
+            with cls._in_phase('gc'):
+                cls.clean_stored_state()
         cls._emit_events()
 
-        for relation_name, relation_api in cls._relation_apis.items():
-            cls._manage_automatic_flags(relation_name, relation_api)
-            if hasattr(relation_api, 'manage_flags'):
-                relation_api.manage_flags()
+        if cls.flag_workers and cls._concurrent_endpoints():
+            cls._manage_flags_concurrently()
+        else:
+            for relation_name in cls._bindings:
+                with cls._in_phase('automatic_flags', relation_name):
+                    cls._manage_automatic_flags(relation_name)
+        with cls._in_phase('automatic_flags'):
+            cls._apply_flags()
+
+        for relation_name in cls._bindings:
+            if cls._has_api(relation_name, 'manage_flags'):
+                with cls._in_phase('manage_flags', relation_name):
+                    cls.from_name(relation_name).manage_flags()
+        cls._start_dispatch()
+
+    @classmethod
+    def _start_dispatch(cls):
+        # Anything after this is done by the reactive handlers.
+        cls._phase = ('dispatch', None)
+        cls._dispatch_start = time.time_ns()
+
+    @classmethod
+    def _prefetch(cls):
+        # During a relation hook for a bound endpoint, we know which relation
+        # data is about to be read, so start fetching it while the charm is
+        # built and any deferred events are re-emitted.
+        relation_name = cls._dispatch.get(hookenv.hook_name(), (None, None))[1]
+        relation_id = os.environ.get('JUJU_RELATION_ID', '')
+        relation_id = relation_id.rpartition(':')[2]
+        if relation_name is None or not relation_id:
+            return
+        # These have to match the calls made by the model exactly.
+        calls = [
+            ('relation-ids', relation_name),
+            ('relation-list', '-r', relation_id),
+        ]
+        remote_unit = os.environ.get('JUJU_REMOTE_UNIT')
+        if remote_unit:
+            calls.append(('relation-get', '-r', relation_id, '-',
+                          remote_unit))
+        remote_app = os.environ.get('JUJU_REMOTE_APP')
+        if remote_app:
+            calls.append(('relation-get', '-r', relation_id, '-', remote_app,
+                          '--app'))
+        _import_ops()
+        cls._backend = cls._create_backend()
+        cls._backend.prefetch(calls)
 
     @classmethod
     def _emit_events(cls):
         # Re-emit deferred events.
-        cls._charm.framework.reemit()
+        with cls._in_phase('reemit'):
+            cls._reemit()
 
-        hook_name = hookenv.hook_name()
+        with cls._in_phase('emit'):
+            cls._emit_hook_event()
 
-        # Check for and emit upgrade_charm event.
-        # (Might be needed for data format changes.)
-        if hook_name == 'upgrade-charm':
-            cls._charm.on.upgrade_charm.emit()
-            return
+    @classmethod
+    def _reemit(cls):
+        framework = cls._charm.framework
+        store = framework._storage
+        notices = list(store.notices())
+        stats = cls.deferred_stats = dict.fromkeys(cls.deferred_stats, 0)
+        if cls.coalesce_deferred and notices:
+            notices = cls._coalesce_notices(store, notices)
+        # Keep the order in which the events were first deferred.
+        event_paths = list(dict.fromkeys(notice[0] for notice in notices))
+        stats['pending'] = len(event_paths)
+        stats['oldest_age'] = cls._track_deferred(event_paths)
 
-        # Check for and emit leader_elected event.
-        # (Might be needed for app rel data.)
-        if hook_name == 'leader-elected':
-            cls._charm.on.leader_elected.emit()
+        if not cls.reemit_limit or len(event_paths) <= cls.reemit_limit:
+            stats['reemitted'] = len(event_paths)
+            framework.reemit()
             return
+        hookenv.log('{} deferred events pending, only re-emitting the oldest '
+                    '{}'.format(len(event_paths), cls.reemit_limit),
+                    hookenv.WARNING)
+        for event_path in event_paths[:cls.reemit_limit]:
+            framework._reemit(event_path)
+        stats['reemitted'] = cls.reemit_limit
 
-        # Check for relation events for bound classes.
-        if '-relation-' not in hook_name:
-            return
-        hook_parts = hook_name.rsplit('-', 2)
-        relation_name = hook_parts[0]
-        if relation_name not in cls._relation_apis:
+    @classmethod
+    def _coalesce_notices(cls, store, notices):
+        # Notices are duplicates if they are for the same observer method,
+        # event type, and event data, in which case only the first is kept.
+        seen = set()
+        kept = []
+        dropped = []
+        for event_path, observer_path, method_name in notices:
+            try:
+                data = store.load_snapshot(event_path)
+            except NoSnapshotError:
+                kept.append((event_path, observer_path, method_name))
+                continue
+            event_kind = event_path.rpartition('[')[0]
+            key = (observer_path, method_name, event_kind,
+                   json.dumps(data, sort_keys=True, default=repr))
+            if key in seen:
+                dropped.append((event_path, observer_path, method_name))
+            else:
+                seen.add(key)
+                kept.append((event_path, observer_path, method_name))
+        for notice in dropped:
+            store.drop_notice(*notice)
+        kept_paths = {notice[0] for notice in kept}
+        for event_path in {notice[0] for notice in dropped} - kept_paths:
+            store.drop_snapshot(event_path)
+        cls.deferred_stats['coalesced'] = len(dropped)
+        return kept
+
+    @classmethod
+    def _track_deferred(cls, event_paths):
+        # Record when each deferred event was first seen, so that we can
+        # report how long the oldest one has been waiting.
+        kv = unitdata.kv()
+        first_seen = kv.get(DEFERRED_KEY) or {}
+        if not (event_paths or first_seen):
+            return None
+        now = time.time()
+        first_seen = {event_path: first_seen.get(event_path, now)
+                      for event_path in event_paths}
+        kv.set(DEFERRED_KEY, first_seen)
+        if not first_seen:
+            return None
+        return now - min(first_seen.values())
+
+    @classmethod
+    def _build_dispatch(cls):
+        # Map each hook which emits an event to the interface API classes to
+        # the name of that event and the endpoint it's for (or None for the
+        # charm-wide events, which are emitted to all of them), so that the
+        # hook name only has to be looked up once.
+        #  * upgrade-charm might be needed for data format changes
+        #  * leader-elected & leader-settings-changed might be needed for app
+        #    relation data
+        #  * the relation events for all bound endpoints, including peers
+        dispatch = {hook_name: (hook_name.replace('-', '_'), None)
+                    for hook_name in CHARM_EVENTS}
+        for relation_name in cls._bindings:
+            for kind in RELATION_EVENTS:
+                hook_name = '{}-relation-{}'.format(relation_name, kind)
+                dispatch[hook_name] = (hook_name.replace('-', '_'),
+                                       relation_name)
+        cls._dispatch = dispatch
+
+    @classmethod
+    def _emit_hook_event(cls):
+        try:
+            event_name, relation_name = cls._dispatch[hookenv.hook_name()]
+        except KeyError:
             return
-        event_name = hook_name.replace('-', '_')
         event = getattr(cls._charm.on, event_name)
-        args, kwargs = _build_event_args(cls, event)
-        event.emit(*args, **kwargs)
+        if relation_name is None:
+            event.emit()
+        else:
+            args, kwargs = _build_event_args(cls, event)
+            event.emit(*args, **kwargs)
 
     @classmethod
-    def _manage_automatic_flags(cls, relation_name, relation_api):
-        prefix = 'endpoint.' + relation_name
-        relations = cls._charm.model.relations[relation_name]
-        toggle_flag(prefix + '.created', len(relations) > 0)
-        toggle_flag(prefix + '.joined', any(len(rel.units) > 0
-                                            for rel in relations))
-        if hasattr(relation_api, 'is_changed'):
-            toggle_flag(prefix + '.changed', relation_api.is_changed)
-
-            def _clear_changed_property_from_flag():
-                try:
-                    relation_api.is_changed = False
-                except AttributeError as e:
-                    if e.args == ("can't set attribute",):
-                        pass
-                    raise
+    def _manage_automatic_flags(cls, relation_name, flags=None):
+        if flags is None:
+            flags = cls._gather_flags(relation_name)
+        for flag, value in flags.items():
+            cls._queue_flag(flag, value)
+        if cls._has_api(relation_name, 'is_changed'):
+            cls._register_changed_trigger(relation_name)
 
-            register_trigger(when_not=prefix + '.changed',
-                             callback=_clear_changed_property_from_flag)
+    @classmethod
+    def _automatic_flags(cls, relation_name):
+        prefix = 'endpoint.' + relation_name
+        flags = {
+            prefix + '.created': cls.relation_count(relation_name) > 0,
+            prefix + '.joined': cls.unit_count(relation_name) > 0,
+        }
+        if cls._has_api(relation_name, 'is_changed'):
+            relation_api = cls.from_name(relation_name)
+            flags[prefix + '.changed'] = relation_api.is_changed
         elif hookenv.hook_name() == relation_name + '-relation-changed':
-            set_flag(prefix + '.changed')
+            flags[prefix + '.changed'] = True
+        return flags
+
+    @classmethod
+    def _concurrent_endpoints(cls):
+        return [relation_name
+                for relation_name, api_class in cls._bindings.items()
+                if getattr(api_class, 'concurrent_flags', False)]
+
+    @classmethod
+    def _manage_flags_concurrently(cls):
+        # Gather the flags for the endpoints whose classes support it in a
+        # pool of threads, while the rest are managed as usual on the main
+        # thread, and then queue them all in the usual order so that they're
+        # applied deterministically.
+        from concurrent.futures import ThreadPoolExecutor
+        concurrent = cls._concurrent_endpoints()
+        # Creating instances and loading their stored state both have to
+        # happen on the main thread.
+        for relation_name in concurrent:
+            if (
+                cls._has_api(relation_name, 'is_changed') or
+                cls._has_api(relation_name, 'gather_flags')
+            ):
+                _prime_stored_state(cls.from_name(relation_name))
+        with ThreadPoolExecutor(max_workers=cls.flag_workers) as pool:
+            futures = {relation_name: pool.submit(cls._gather_flags,
+                                                  relation_name)
+                       for relation_name in concurrent}
+            for relation_name in cls._bindings:
+                with cls._in_phase('automatic_flags', relation_name):
+                    if relation_name in futures:
+                        flags = futures[relation_name].result()
+                        cls._manage_automatic_flags(relation_name, flags)
+                    else:
+                        cls._manage_automatic_flags(relation_name)
+
+    @classmethod
+    def _gather_flags(cls, relation_name):
+        # This may be run in a worker thread, so it must only read from the
+        # model, and the phase is tracked per thread.
+        try:
+            cls._worker_phase.value = ('automatic_flags', relation_name)
+            with cls._span('gather_flags', endpoint=relation_name):
+                flags = cls._automatic_flags(relation_name)
+                if cls._has_api(relation_name, 'gather_flags'):
+                    cls._worker_phase.value = ('manage_flags', relation_name)
+                    relation_api = cls.from_name(relation_name)
+                    flags.update(relation_api.gather_flags())
+            return flags
+        finally:
+            cls._worker_phase.value = None
+
+    @classmethod
+    def _register_changed_trigger(cls, relation_name):
+        # Trigger callbacks only live as long as the process, but they only
+        # need to be registered once per endpoint for it.
+        if relation_name in cls._changed_triggers:
+            return
+        callback = partial(cls._clear_changed, relation_name)
+        register_trigger(when_not='endpoint.{}.changed'.format(relation_name),
+                         callback=callback)
+        cls._changed_triggers[relation_name] = callback
+
+    @classmethod
+    def _clear_changed(cls, relation_name):
+        # Shared callback for the triggers on the .changed flags, which maps
+        # the cleared flag back to the current instance for its endpoint.
+        relation_api = cls.from_name(relation_name)
+        if relation_api is None:
+            return
+        is_changed = getattr(type(relation_api), 'is_changed', None)
+        if is_changed is None:
+            # The triggers outlive the hook, so the endpoint may since have
+            # been bound to a class which doesn't track changes.
+            return
+        if isinstance(is_changed, property) and is_changed.fset is None:
+            # Read-only property.
+            return
+        relation_api.is_changed = False
+
+    @classmethod
+    def _queue_flag(cls, flag, value):
+        cls._pending_flags[flag] = bool(value)
+
+    @classmethod
+    def _apply_flags(cls):
+        # Diff the queued flags against the set flags with a single read, and
+        # only set or clear the flags which actually change, so that flags
+        # which already have the right value don't cause any unitdata writes
+        # or trigger work. Changing a flag can run triggers which change other
+        # flags, though, so the set flags have to be read again after that.
+        cls.flag_stats = dict.fromkeys(cls.flag_stats, 0)
+        current = set(get_flags())
+        for flag, value in cls._pending_flags.items():
+            if value == (flag in current):
+                cls.flag_stats['skipped'] += 1
+                continue
+            cls.flag_stats['changed'] += 1
+            if value:
+                set_flag(flag)
+            else:
+                clear_flag(flag)
+            current = set(get_flags())
+        cls._pending_flags = {}
 
     @classmethod
     def _shutdown(cls):
-        cls._charm.framework.commit()
-        cls._charm.framework.close()
+        cls._registered = False
+        if cls.trace and cls._dispatch_start is not None:
+            cls._spans.append({
+                'name': 'dispatch',
+                'spanId': os.urandom(8).hex(),
+                'parentSpanId': '',
+                'start': cls._dispatch_start,
+                'end': time.time_ns(),
+                'attributes': {},
+            })
+        # Nothing is built during a fast path hook, so there's nothing to
+        # save.
+        if cls._charm is not None:
+            cls._save()
+        if cls.trace:
+            cls._export_trace()
+        if cls._recording is not None:
+            cls._save_recording()
+
+    @classmethod
+    def _save(cls):
+        with cls._in_phase('shutdown'):
+            if isinstance(cls._backend, _BufferedBackend):
+                cls._backend.flush()
+            cls._charm.framework.commit()
+            cls._charm.framework.close()
+        # Logging runs juju-log, so the stats are only logged when the hook
+        # is being instrumented anyway.
+        stats = cls.storage_stats
+        if cls.instrument and (stats['rows'] or stats['unchanged']):
+            hookenv.log('ops_reactive_interface: wrote {} stored state rows '
+                        '({} bytes), {} unchanged'.format(
+                            stats['rows'], stats['bytes'], stats['unchanged']),
+                        hookenv.DEBUG)
+        if cls.instrument and isinstance(cls._backend, _CachingBackend):
+            stats = cls._backend.cache_stats
+            hookenv.log('ops_reactive_interface: hook tool cache hit rate '
+                        '{:.0%} ({} hits, {} misses, {} prefetched, '
+                        '{} invalidated)'.format(
+                            cls._backend.hit_rate(), stats['hits'],
+                            stats['misses'], stats['prefetched'],
+                            stats['invalidated']),
+                        hookenv.DEBUG)
+        if isinstance(cls._backend, _InstrumentedBackend):
+            cls._report_hook_tools()
+
+    @classmethod
+    def _report_hook_tools(cls):
+        summary = cls._backend.summary()
+        phases = []
+        for phase, tools in summary['phases'].items():
+            phases.append('{}: {}'.format(phase, ', '.join(
+                '{} x{} {:.3f}s'.format(tool, count, duration)
+                for tool, (count, duration) in sorted(tools.items()))))
+        message = 'ops_reactive_interface: {} hook tool calls in {:.3f}s'
+        message = message.format(summary['calls'], summary['duration'])
+        hookenv.log('{} ({})'.format(message, '; '.join(phases)),
+                    hookenv.DEBUG)
+        record = dict(summary,
+                      hook=hookenv.hook_name(),
+                      timestamp=time.time(),
+                      records=cls._backend.calls)
+        try:
+            with (_state_dir() / HOOK_TOOLS_FILE).open('a') as fp:
+                fp.write(json.dumps(record) + '\n')
+        except OSError as e:
+            hookenv.log('Unable to save hook tool calls: {}'.format(e),
+                        hookenv.WARNING)
+
+    @classmethod
+    def _export_trace(cls):
+        # Write all of the spans for the hook as a single OTLP JSON trace
+        # export request, one per line, which can be picked up by any
+        # collector which understands that format.
+        hook_name = hookenv.hook_name()
+        trace_id = os.urandom(16).hex()
+        # Everything is nested under a span for the whole hook, from when
+        # this module was imported or, for later hooks in the same process,
+        # from when their context was created.
+        root = {
+            'name': 'hook',
+            'spanId': os.urandom(8).hex(),
+            'parentSpanId': '',
+            'start': cls._hook_start,
+            'end': time.time_ns(),
+            'attributes': {},
+        }
+        spans = [root]
+        if cls._hook_start == _IMPORT_START:
+            spans.append({
+                'name': 'import',
+                'spanId': os.urandom(8).hex(),
+                'parentSpanId': root['spanId'],
+                'start': _IMPORT_START,
+                'end': _IMPORT_END,
+                'attributes': {},
+            })
+        for span in cls._spans:
+            spans.append(dict(span, parentSpanId=span['parentSpanId'] or
+                              root['spanId']))
+        cls._spans = []
+
+        def attributes(values):
+            return [{'key': key, 'value': {'stringValue': str(value)}}
+                    for key, value in values.items()]
+
+        record = {'resourceSpans': [{
+            'resource': {'attributes': attributes({
+                'service.name': 'ops-reactive-interface',
+                'juju.model': os.environ.get('JUJU_MODEL_NAME', ''),
+                'juju.unit': os.environ.get('JUJU_UNIT_NAME', ''),
+            })},
+            'scopeSpans': [{
+                'scope': {'name': 'ops_reactive_interface'},
+                'spans': [{
+                    'traceId': trace_id,
+                    'spanId': span['spanId'],
+                    'parentSpanId': span['parentSpanId'],
+                    'name': span['name'],
+                    'kind': 1,
+                    'startTimeUnixNano': str(span['start']),
+                    'endTimeUnixNano': str(span['end']),
+                    'attributes': attributes(
+                        dict(span['attributes'], **{'juju.hook': hook_name})),
+                } for span in spans],
+            }],
+        }]}
+        try:
+            with (_state_dir() / TRACE_FILE).open('a') as fp:
+                fp.write(json.dumps(record) + '\n')
+        except OSError as e:
+            hookenv.log('Unable to save trace: {}'.format(e),
+                        hookenv.WARNING)
+
+    @classmethod
+    def _save_recording(cls):
+        # Write everything needed to replay the hook offline as a single JSON
+        # line; see tests/benchmark/replay.py.
+        recording, cls._recording = cls._recording, None
+        if isinstance(cls._backend, _RecordingBackend):
+            calls = cls._backend.recorded
+        else:
+            # The charm was never built, so no hook tools were run.
+            calls = []
+        record = {
+            'version': RECORDING_VERSION,
+            'hook': hookenv.hook_name(),
+            'timestamp': recording['start'],
+            'duration': time.time() - recording['start'],
+            'versions': _versions(),
+            'env': {key: value for key, value in os.environ.items()
+                    if key.startswith(('JUJU_', 'ORI_'))},
+            'metadata': cls._get_metadata(),
+            'calls': calls,
+            'state_before': recording['before'],
+            'state_after': _dump_state(),
+        }
+        try:
+            with (_state_dir() / RECORDING_FILE).open('a') as fp:
+                fp.write(json.dumps(record, default=str) + '\n')
+        except OSError as e:
+            hookenv.log('Unable to save recording: {}'.format(e),
+                        hookenv.WARNING)
+
 
+_IMPORT_END = time.time_ns()
 
-hookenv.atstart(InterfaceAPIFactory._startup)
-hookenv.atexit(InterfaceAPIFactory._shutdown)
+InterfaceAPIFactory.register()
@@ -0,0 +1,223 @@
+"""Helpers for interface API classes.
+
+Unlike ``ops_reactive_interface``, this module doesn't depend on the
+charms.reactive framework, so it can be used by interface API classes in both
+Operator framework and charms.reactive charms.
+"""
+import json
+from hashlib import md5
+from itertools import chain
+
+from ops.framework import Object, StoredState
+
+
+class ChangeTracker(Object):
+    """Track changes to the remote data on an endpoint's relations.
+
+    A digest of each remote application and unit data bag is kept in stored
+    state when the changes are acknowledged, and ``is_changed`` reports
+    whether any of them differ from that.
+
+    Remote data can only change between relation events, so the digests of
+    the bags seen so far are also kept across hooks, and only the bags which
+    a relation event says may have changed (or which haven't been seen
+    before) are fetched and hashed again. This means that checking
+    ``is_changed`` on an endpoint with many units is cheap, no matter how
+    many times it's checked.
+
+    The tracker's state is kept under ``parent`` (which should generally be
+    the interface API instance), or the charm if not given. It has to be
+    created before the relation events for the hook are emitted, which is
+    always the case if it's created in the interface API's ``__init__``.
+
+    This can be used to implement the ``is_changed`` property for the
+    ``.changed`` flag::
+
+        class MyInterface(Object):
+            def __init__(self, charm, relation_name):
+                super().__init__(charm, relation_name)
+                self.changes = ChangeTracker(charm, relation_name,
+                                             parent=self)
+
+            @property
+            def is_changed(self):
+                return self.changes.is_changed
+
+            @is_changed.setter
+            def is_changed(self, value):
+                if not value:
+                    self.changes.acknowledge()
+    """
+
+    _stored = StoredState()
+
+    def __init__(self, charm, relation_name, parent=None):
+        super().__init__(parent or charm, relation_name)
+        self.relation_name = relation_name
+        # Digests as of when the changes were last acknowledged, and as of
+        # when each bag was last fetched, by relation ID and bag name.
+        self._stored.set_default(digests={}, seen={})
+        self._seen = {relation_id: dict(bags)
+                      for relation_id, bags in self._stored.seen.items()}
+        events = charm.on[relation_name]
+        for event in (events.relation_joined,
+                      events.relation_changed,
+                      events.relation_departed,
+                      events.relation_broken):
+            self.framework.observe(event, self._on_relation_event)
+
+    def _on_relation_event(self, event):
+        bags = self._seen.get(str(event.relation.id))
+        names = {entity.name for entity in (event.unit, event.app)
+                 if entity is not None}
+        if not bags or not names & set(bags):
+            return
+        for name in names:
+            bags.pop(name, None)
+        # The stored digests have to be forgotten too, since nothing may
+        # check for changes before this hook's state is committed.
+        self._stored.seen = {relation_id: dict(bags)
+                             for relation_id, bags in self._seen.items()}
+
+    def refresh(self):
+        """Forget the digests of the bags seen so far."""
+        self._seen = {}
+        self._stored.seen = {}
+
+    def digests(self):
+        """Current digests of each remote data bag, by relation ID and name."""
+        digests = {}
+        for relation in self.model.relations[self.relation_name]:
+            seen = self._seen.get(str(relation.id), {})
+            bags = digests[str(relation.id)] = {}
+            entities = list(relation.units)
+            if relation.app is not None:
+                entities.append(relation.app)
+            for entity in entities:
+                if entity.name in seen:
+                    bags[entity.name] = seen[entity.name]
+                    continue
+                serialized = json.dumps(dict(relation.data[entity]),
+                                        sort_keys=True)
+                digest = md5(serialized.encode('utf8')).hexdigest()
+                bags[entity.name] = digest
+        if digests != self._seen:
+            self._seen = {relation_id: dict(bags)
+                          for relation_id, bags in digests.items()}
+            self._stored.seen = digests
+        return digests
+
+    def changes(self):
+        """List of ``(relation ID, name)`` of the bags which have changed.
+
+        This includes any bags which have been added or removed.
+        """
+        current = self.digests()
+        stored = self._stored.digests
+        changes = []
+        for relation_id in sorted(set(current) | set(stored), key=int):
+            current_bags = current.get(relation_id, {})
+            stored_bags = stored.get(relation_id, {})
+            for name in sorted(set(current_bags) | set(stored_bags)):
+                if current_bags.get(name) != stored_bags.get(name):
+                    changes.append((int(relation_id), name))
+        return changes
+
+    @property
+    def is_changed(self):
+        """Whether any remote data has changed since it was acknowledged."""
+        return self.digests() != self._stored.digests
+
+    def acknowledge(self):
+        """Record the current remote data as having been seen."""
+        self._stored.digests = self.digests()
+
+
+class InterfaceAPI(Object):
+    """Base class for interface API classes.
+
+    Provides the ``charm``, ``relation_name`` and ``relations`` attributes
+    which most interface API classes need, along with queries which scale to
+    endpoints with thousands of related units: counts and existence checks
+    which don't fetch any relation data, and generators over the remote units
+    and data which only fetch each data bag as it's reached, so that a caller
+    which stops early never fetches the rest::
+
+        class MyInterface(InterfaceAPI):
+            @property
+            def is_ready(self):
+                return self.any_remote_data('address')
+
+            @property
+            def addresses(self):
+                for _, _, address in self.iter_remote_data('address'):
+                    yield address
+
+    Units are generated in no particular order.
+    """
+
+    def __init__(self, charm, relation_name):
+        super().__init__(charm, relation_name)
+        self.charm = charm
+        self.relation_name = relation_name
+
+    @property
+    def relations(self):
+        """The relations on this endpoint."""
+        return self.model.relations[self.relation_name]
+
+    def relation_count(self):
+        """Number of relations on this endpoint."""
+        return len(self.relations)
+
+    def unit_count(self):
+        """Number of remote units across all of this endpoint's relations."""
+        return sum(len(relation.units) for relation in self.relations)
+
+    def is_created(self):
+        """Whether there are any relations on this endpoint."""
+        return self.relation_count() > 0
+
+    def is_joined(self):
+        """Whether any relation on this endpoint has a remote unit."""
+        return any(relation.units for relation in self.relations)
+
+    def iter_units(self):
+        """Generate ``(relation, unit)`` for each remote unit."""
+        for relation in self.relations:
+            for unit in relation.units:
+                yield relation, unit
+
+    def iter_remote_data(self, key=None, apps=True, units=True):
+        """Generate ``(relation, entity, data)`` for the remote data bags.
+
+        For each relation, the remote application's bag is generated first
+        (if ``apps``), followed by those of the remote units (if ``units``).
+        If ``key`` is given, the value of that key is generated instead of
+        the whole bag, and bags which don't have it are skipped.
+        """
+        for relation in self.relations:
+            entities = []
+            if apps and relation.app is not None:
+                entities.append(relation.app)
+            for entity in chain(entities, relation.units if units else ()):
+                data = relation.data[entity]
+                if key is None:
+                    yield relation, entity, data
+                elif key in data:
+                    yield relation, entity, data[key]
+
+    def any_remote_data(self, key=None, apps=True, units=True):
+        """Whether any remote bag has ``key`` (or any data at all).
+
+        This stops fetching bags as soon as one is found.
+        """
+        for _, _, data in self.iter_remote_data(key, apps, units):
+            if key is not None or data:
+                return True
+        return False
+
+    def count_remote_data(self, key=None, apps=True, units=True):
+        """Number of remote bags which have ``key`` (or any data at all)."""
+        return sum(1 for _, _, data in self.iter_remote_data(key, apps, units)
+                   if key is not None or data)
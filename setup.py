@@ -7,7 +7,10 @@ SETUP = {
     'author': "Cory Johns",
     'author_email': "cory.johns@canonical.com",
     'url': "https://github.com/juju-solutions/ops-reactive-interface",
-    'py_modules': ['ops_reactive_interface'],
+    'py_modules': [
+        'ops_reactive_interface',
+        'ops_reactive_interface_helpers',
+    ],
     'install_requires': [
         'ops>=1.0.0',
     ],
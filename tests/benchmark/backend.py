@@ -0,0 +1,86 @@
+import yaml
+
+from ops.model import ModelError, _ModelBackend
+
+
+class FakeRelation:
+    def __init__(self, name, relation_id, app, units):
+        self.name = name
+        self.id = relation_id
+        self.app = app
+        self.units = list(units)
+        # Relation data, keyed by unit or app name.
+        self.data = {}
+
+
+class FakeBackend(_ModelBackend):
+    """In-memory stand-in for the hook tools used by the charm model.
+
+    Rather than running the hook tools, the commands which would be run are
+    answered from the relations given to the backend, and counted in
+    ``counts`` (which can be shared between backends).
+    """
+
+    def __init__(self, relations=(), is_leader=True, config=None,
+                 counts=None):
+        super().__init__()
+        self.relations = {relation.id: relation for relation in relations}
+        self.leader = is_leader
+        self.config = config or {}
+        self.counts = {} if counts is None else counts
+
+    def add_relation(self, relation):
+        self.relations[relation.id] = relation
+
+    def _run(self, *args, return_output=False, use_json=False,
+             input_stream=None):
+        tool, args = args[0], list(args[1:])
+        self.counts[tool] = self.counts.get(tool, 0) + 1
+        handler = getattr(self, '_' + tool.replace('-', '_'), None)
+        if handler is None:
+            raise ModelError('{}: not supported by FakeBackend'.format(tool))
+        return handler(args, input_stream)
+
+    def _relation(self, args):
+        relation_id = int(args[args.index('-r') + 1])
+        if relation_id not in self.relations:
+            raise ModelError('ERROR relation not found')
+        return self.relations[relation_id]
+
+    def _relation_ids(self, args, input_stream):
+        return ['{}:{}'.format(relation.name, relation.id)
+                for relation in self.relations.values()
+                if relation.name == args[0]]
+
+    def _relation_list(self, args, input_stream):
+        relation = self._relation(args)
+        if '--app' in args:
+            return relation.app
+        return relation.units
+
+    def _relation_get(self, args, input_stream):
+        relation = self._relation(args)
+        member = args[args.index('-') + 1]
+        return dict(relation.data.get(member, {}))
+
+    def _relation_set(self, args, input_stream):
+        relation = self._relation(args)
+        if '--app' in args:
+            member = self.app_name
+        else:
+            member = self.unit_name
+        data = relation.data.setdefault(member, {})
+        for key, value in yaml.safe_load(input_stream).items():
+            if value:
+                data[key] = value
+            else:
+                data.pop(key, None)
+
+    def _is_leader(self, args, input_stream):
+        return self.leader
+
+    def _config_get(self, args, input_stream):
+        return dict(self.config)
+
+    def _juju_log(self, args, input_stream):
+        return None
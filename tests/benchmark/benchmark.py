@@ -0,0 +1,282 @@
+"""Offline benchmark of the factory's per-hook overhead at scale.
+
+Runs ``InterfaceAPIFactory.load``, ``_startup`` and ``_shutdown`` for a
+synthetic charm with many endpoints and related units, using the patched
+reactive layer from ``charms.unit_test`` and an in-memory stand-in for the
+hook tools, and reports the wall time, hook tool calls and peak memory of
+each phase. The management of the flags, which is part of startup, is also
+reported separately, as its cost shouldn't grow with the number of units.
+
+Example::
+
+    tox -e benchmark -- --endpoints 200 --units 20 --json
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from statistics import median
+from unittest.mock import patch
+
+from charms.unit_test import patch_reactive
+
+sys.path.insert(0, str(Path(__file__).parent))
+from backend import FakeBackend, FakeRelation  # noqa: E402
+
+# tracemalloc.reset_peak() is new in Python 3.9. Without it, the memory used
+# by the flag phases is measured as the growth in traced memory instead.
+_reset_peak = getattr(tracemalloc, 'reset_peak', None)
+
+
+PHASES = ('load', 'startup', 'flags', 'shutdown')
+# The phases of startup in which the flags are managed.
+FLAG_PHASES = ('automatic_flags', 'manage_flags')
+
+
+def synthetic_metadata(endpoints, interface='ori-test'):
+    metadata = {'name': 'bench', 'provides': {}, 'requires': {}}
+    for i in range(endpoints):
+        role = 'provides' if i % 2 else 'requires'
+        metadata[role]['ep{}'.format(i)] = {'interface': interface}
+    return metadata
+
+
+def synthetic_relations(metadata, relations, units):
+    result = []
+    relation_id = 0
+    for role in ('provides', 'requires'):
+        for endpoint_name in metadata[role]:
+            for _ in range(relations):
+                relation_id += 1
+                app = 'remote{}'.format(relation_id)
+                relation = FakeRelation(
+                    endpoint_name, relation_id, app,
+                    ['{}/{}'.format(app, i) for i in range(units)])
+                relation.data[app] = {'sent': 'value{}'.format(relation_id)}
+                for unit_name in relation.units:
+                    relation.data[unit_name] = {'address': unit_name}
+                result.append(relation)
+    return result
+
+
+def _hook_env(hook, relations):
+    env = {'JUJU_VERSION': '3.6.2', 'JUJU_HOOK_NAME': hook}
+    if '-relation-' in hook:
+        endpoint_name = hook.rsplit('-', 2)[0]
+        relation = next(r for r in relations if r.name == endpoint_name)
+        env.update({
+            'JUJU_RELATION': endpoint_name,
+            'JUJU_RELATION_ID': '{}:{}'.format(endpoint_name, relation.id),
+            'JUJU_REMOTE_APP': relation.app,
+        })
+        if relation.units:
+            env['JUJU_REMOTE_UNIT'] = relation.units[0]
+    return env
+
+
+def run_hook(metadata, relations, hook, state_dir, trace_memory=False):
+    """Run a single hook through the factory and measure each phase."""
+    import ops_reactive_interface as ori
+    from charms.unit_test import MockKV, flags
+    from charmhelpers.core import hookenv, unitdata
+
+    flags.clear()
+    hookenv.metadata.return_value = metadata
+    hookenv.charm_dir.return_value = str(state_dir)
+    hookenv.hook_name.return_value = hook
+    kv = unitdata.kv.return_value = MockKV()
+    kv.conn = sqlite3.connect(str(state_dir / '.unit-state.db'))
+    # The backend class is patched rather than the instance, so that the
+    # factory can still mix its options into it.
+    counts = {}
+    backend_class = type('FakeBackend', (FakeBackend,), {
+        '__init__': lambda self: FakeBackend.__init__(
+            self, relations, counts=counts),
+    })
+
+    IAF = ori.InterfaceAPIFactory
+    results = {'flags': {'time': 0.0,
+                         'peak_memory': 0 if trace_memory else None,
+                         'hook_tools': {}}}
+    in_phase = IAF._in_phase
+    # Peaks seen during startup before the flag phases reset them.
+    peaks = []
+
+    @contextmanager
+    def measured_phase(phase, endpoint=None):
+        # Flag management happens during startup, in several phases, and is
+        # measured separately so that its cost can be compared at scale.
+        with in_phase(phase, endpoint):
+            if phase not in FLAG_PHASES:
+                yield
+                return
+            flag_results = results['flags']
+            calls = dict(counts)
+            if trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                if _reset_peak:
+                    peaks.append(peak)
+                    _reset_peak()
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                flag_results['time'] += time.perf_counter() - start
+                for tool, count in counts.items():
+                    if count - calls.get(tool, 0):
+                        flag_results['hook_tools'][tool] = (
+                            flag_results['hook_tools'].get(tool, 0) +
+                            count - calls.get(tool, 0))
+                if trace_memory:
+                    traced = tracemalloc.get_traced_memory()
+                    flag_results['peak_memory'] = max(
+                        flag_results['peak_memory'],
+                        traced[1 if _reset_peak else 0] - current)
+
+    with patch.object(ori, '_ModelBackend', backend_class), \
+            patch.object(IAF, '_in_phase', measured_phase):
+        for phase, func in (('load', IAF.load),
+                            ('startup', IAF._startup),
+                            ('shutdown', IAF._shutdown)):
+            calls = dict(counts)
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            func()
+            duration = time.perf_counter() - start
+            if trace_memory:
+                peak = max(peaks + [tracemalloc.get_traced_memory()[1]])
+                peaks.clear()
+                tracemalloc.stop()
+            else:
+                peak = None
+            results[phase] = {
+                'time': duration,
+                'peak_memory': peak,
+                'hook_tools': {
+                    tool: count - calls.get(tool, 0)
+                    for tool, count in counts.items()
+                    if count - calls.get(tool, 0)
+                },
+            }
+    kv.conn.commit()
+    kv.conn.close()
+    return results
+
+
+def run_benchmark(endpoints=10, relations=1, units=3, hook='update-status',
+                  repeat=5, in_process=False):
+    """Run the benchmark and return the results for each phase.
+
+    Each run is done with a fresh import of the factory (as each hook would
+    be a fresh process), or with a new context of the same factory if
+    ``in_process``, but with the on-disk state from the previous runs. The
+    first run is not counted, so that the results reflect steady-state hooks.
+    """
+    metadata = synthetic_metadata(endpoints)
+    fake_relations = synthetic_relations(metadata, relations, units)
+    sys_modules = sys.modules.copy()
+    environ = os.environ.copy()
+    try:
+        patch_reactive()
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_dir = Path(state_dir)
+            os.environ.update(_hook_env(hook, fake_relations))
+            os.environ['UNIT_STATE_DB'] = str(state_dir / '.unit-state.db')
+            runs = []
+            for i in range(repeat + 2):
+                if in_process and i:
+                    ori = sys.modules['ops_reactive_interface']
+                    ori.InterfaceAPIFactory.create_context()
+                else:
+                    sys.modules.pop('ops_reactive_interface', None)
+                # The first run warms up the on-disk state, and the last is
+                # only used to measure memory, since tracing slows it down.
+                runs.append(run_hook(metadata, fake_relations, hook,
+                                     state_dir, trace_memory=i > repeat))
+    finally:
+        sys.modules.clear()
+        sys.modules.update(sys_modules)
+        os.environ.clear()
+        os.environ.update(environ)
+
+    timed, traced = runs[1:-1], runs[-1]
+    return {
+        'parameters': {
+            'endpoints': endpoints,
+            'relations': relations,
+            'units': units,
+            'hook': hook,
+            'repeat': repeat,
+            'in_process': in_process,
+        },
+        'phases': {
+            phase: {
+                'time': median(run[phase]['time'] for run in timed),
+                'peak_memory': traced[phase]['peak_memory'],
+                'hook_tools': traced[phase]['hook_tools'],
+            }
+            for phase in PHASES
+        },
+    }
+
+
+def format_results(results):
+    params = results['parameters']
+    lines = [
+        '{endpoints} endpoints x {relations} relations x {units} units, '
+        'hook {hook}, median of {repeat} runs'.format(**params),
+        '{:<10} {:>10} {:>12} {:>10}  {}'.format(
+            'phase', 'time (ms)', 'peak (KiB)', 'tool calls', 'by tool'),
+    ]
+    for phase, result in results['phases'].items():
+        tools = result['hook_tools']
+        lines.append('{:<10} {:>10.2f} {:>12.1f} {:>10}  {}'.format(
+            phase,
+            result['time'] * 1000,
+            result['peak_memory'] / 1024,
+            sum(tools.values()),
+            ', '.join('{}={}'.format(tool, count)
+                      for tool, count in sorted(tools.items()))))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--endpoints', type=int, default=100,
+                        help='Number of endpoints in the charm metadata')
+    parser.add_argument('--relations', type=int, default=1,
+                        help='Number of relations per endpoint')
+    parser.add_argument('--units', type=int, default=10,
+                        help='Number of remote units per relation')
+    parser.add_argument('--hook', default='update-status',
+                        help='Name of the hook to run, e.g. '
+                             'ep0-relation-changed')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed runs')
+    parser.add_argument('--in-process', action='store_true',
+                        help='Run each hook in a new context of the same '
+                             'factory, rather than a fresh import')
+    parser.add_argument('--json', action='store_true',
+                        help='Output the results as JSON')
+    opts = parser.parse_args(args)
+    results = run_benchmark(endpoints=opts.endpoints,
+                            relations=opts.relations,
+                            units=opts.units,
+                            hook=opts.hook,
+                            repeat=opts.repeat,
+                            in_process=opts.in_process)
+    if opts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Replay a hook recorded with ORI_RECORD offline.
+
+Restores the unit's state from before the recorded hook, then runs
+``InterfaceAPIFactory.load``, ``_startup`` and ``_shutdown`` with the hook's
+environment, using the patched reactive layer from ``charms.unit_test`` and
+answering the hook tools from the recorded responses. Reports the wall time
+of each phase, any hook tool calls which differ from the recording, and any
+differences from the state recorded at the end of the hook. The charm's
+interface API classes must be installed wherever the hook is replayed.
+
+The reactive handlers are not run, so the hook tool calls they made are
+reported separately, and any changes they made to the unit's state will show
+up as differences.
+
+Example::
+
+    tox -e replay -- .ops-reactive-interface-recordings.jsonl --profile
+"""
+import argparse
+import base64
+import cProfile
+import io
+import json
+import os
+import pstats
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from pathlib import Path
+from unittest.mock import patch
+
+from charms.unit_test import patch_reactive
+from ops.model import ModelError, _ModelBackend
+
+
+FLAG_PREFIX = 'reactive.states.'
+
+
+def _key(args, input_stream):
+    return (tuple(args), input_stream)
+
+
+class ReplayBackend(_ModelBackend):
+    """Stand-in for the hook tools which answers from a recording.
+
+    Each call is answered with the response recorded for the next call with
+    the same arguments and input, or with the last such response once they've
+    all been used. Calls which weren't recorded at all return nothing, or
+    fail if they need output. Every call made is listed in ``replayed``.
+    """
+
+    recorded_calls = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replayed = []
+        self.responses = {}
+        for call in self.recorded_calls:
+            key = _key(call['args'], call['input'])
+            self.responses.setdefault(key, deque()).append(call)
+
+    def _run(self, *args, return_output=False, use_json=False,
+             input_stream=None):
+        key = _key(args, input_stream)
+        self.replayed.append(key)
+        responses = self.responses.get(key)
+        if not responses:
+            if return_output:
+                raise ModelError('{}: not in the recording'.format(args[0]))
+            return None
+        call = responses.popleft() if len(responses) > 1 else responses[0]
+        if 'error' in call:
+            raise ModelError(call['error'])
+        return call.get('output')
+
+
+def load_recording(path, index=-1):
+    """Load one recorded hook (the last, by default) from a recording file.
+    """
+    with open(path) as fp:
+        recordings = [json.loads(line) for line in fp if line.strip()]
+    return recordings[index]
+
+
+def _restore_state(state, state_dir):
+    from charms.unit_test import MockKV, flags
+    from charmhelpers.core import unitdata
+
+    flags.clear()
+    flags.update(state['flags'])
+    kv = unitdata.kv.return_value = MockKV(_without_flags(state['kv']))
+    kv.conn = sqlite3.connect(str(state_dir / '.unit-state.db'))
+    kv.conn.execute('CREATE TABLE snapshot '
+                    '(handle TEXT PRIMARY KEY, data BLOB)')
+    kv.conn.execute('CREATE TABLE notice ('
+                    'sequence INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'event_path TEXT, observer_path TEXT, method_name TEXT)')
+    kv.conn.executemany('INSERT INTO snapshot VALUES (?, ?)', [
+        (handle, base64.b64decode(data))
+        for handle, data in state['snapshots'].items()])
+    kv.conn.executemany('INSERT INTO notice (event_path, observer_path, '
+                        'method_name) VALUES (?, ?, ?)', state['notices'])
+    kv.conn.commit()
+    return kv
+
+
+def _without_flags(kv):
+    # The flags are also kept in the key / value store by the reactive
+    # framework, but they're restored and compared separately.
+    return {key: value for key, value in kv.items()
+            if not key.startswith(FLAG_PREFIX)}
+
+
+def _compare_state(recorded, replayed):
+    def changed(recorded, replayed):
+        return sorted(key for key in recorded.keys() | replayed.keys()
+                      if recorded.get(key) != replayed.get(key))
+
+    return {
+        'flags': {
+            'missing': sorted(set(recorded['flags']) -
+                              set(replayed['flags'])),
+            'extra': sorted(set(replayed['flags']) - set(recorded['flags'])),
+        },
+        'kv': changed(_without_flags(recorded['kv']),
+                      _without_flags(replayed['kv'])),
+        'snapshots': changed(recorded['snapshots'], replayed['snapshots']),
+        'notices': recorded['notices'] != replayed['notices'],
+    }
+
+
+def _compare_calls(recorded, backend):
+    # Calls made by the reactive handlers can't be replayed, so they're only
+    # counted.
+    handlers = [call for call in recorded if call.get('phase') == 'dispatch']
+    expected = Counter(_key(call['args'], call['input'])
+                       for call in recorded if call.get('phase') != 'dispatch')
+    actual = Counter(backend.replayed)
+
+    def listing(calls):
+        return [{'args': list(args), 'input': input_stream, 'count': count}
+                for (args, input_stream), count in sorted(
+                    calls.items(), key=lambda item: item[0][0])]
+
+    return {
+        'recorded': len(recorded),
+        'replayed': len(backend.replayed),
+        'handlers': len(handlers),
+        'missing': listing(expected - actual),
+        'extra': listing(actual - expected),
+    }
+
+
+def replay_hook(recording, state_dir, profile=False):
+    """Replay a single recorded hook and measure each phase."""
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+
+    hookenv.metadata.return_value = recording['metadata']
+    hookenv.charm_dir.return_value = str(state_dir)
+    hookenv.hook_name.return_value = recording['hook']
+    kv = _restore_state(recording['state_before'], state_dir)
+    backend_class = type('ReplayBackend', (ReplayBackend,),
+                         {'recorded_calls': recording['calls']})
+
+    IAF = ori.InterfaceAPIFactory
+    results = {'phases': {}}
+    profiler = cProfile.Profile() if profile else None
+    with patch.object(ori, '_ModelBackend', backend_class):
+        for phase, func in (('load', IAF.load),
+                            ('startup', IAF._startup),
+                            ('shutdown', IAF._shutdown)):
+            calls = len(IAF._backend.replayed) if IAF._backend else 0
+            start = time.perf_counter()
+            if profiler:
+                profiler.enable()
+            func()
+            if profiler:
+                profiler.disable()
+            results['phases'][phase] = {
+                'time': time.perf_counter() - start,
+                'hook_tools': (len(IAF._backend.replayed) if IAF._backend
+                               else 0) - calls,
+            }
+        state = ori._dump_state()
+        backend = IAF._backend or backend_class()
+    kv.conn.commit()
+    kv.conn.close()
+
+    results['calls'] = _compare_calls(recording['calls'], backend)
+    results['state'] = _compare_state(recording['state_after'], state)
+    if profiler:
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats('cumulative').print_stats(30)
+        results['profile'] = output.getvalue()
+    return results
+
+
+def replay(recording, profile=False):
+    """Replay a recorded hook and return the results.
+
+    The replay is done with a fresh import of the factory, using the options
+    from the recorded environment (other than recording itself).
+    """
+    sys_modules = sys.modules.copy()
+    environ = os.environ.copy()
+    try:
+        patch_reactive()
+        with tempfile.TemporaryDirectory() as state_dir:
+            state_dir = Path(state_dir)
+            for key in list(os.environ):
+                if key.startswith(('JUJU_', 'ORI_')):
+                    del os.environ[key]
+            os.environ.update(recording['env'])
+            os.environ.pop('ORI_RECORD', None)
+            os.environ['UNIT_STATE_DB'] = str(state_dir / '.unit-state.db')
+            sys.modules.pop('ops_reactive_interface', None)
+            import ops_reactive_interface as ori
+            results = replay_hook(recording, state_dir, profile=profile)
+            versions = ori._versions()
+    finally:
+        sys.modules.clear()
+        sys.modules.update(sys_modules)
+        os.environ.clear()
+        os.environ.update(environ)
+
+    return dict(results, **{
+        'hook': recording['hook'],
+        'recorded': {
+            'duration': recording['duration'],
+            'versions': recording['versions'],
+        },
+        'versions': versions,
+    })
+
+
+def format_results(results):
+    recorded = results['recorded']
+    lines = [
+        'hook {}, recorded in {:.2f}ms'.format(
+            results['hook'], recorded['duration'] * 1000),
+    ]
+    for dist, version in sorted(results['versions'].items()):
+        if version != recorded['versions'].get(dist):
+            lines.append('{}: {} (recorded with {})'.format(
+                dist, version, recorded['versions'].get(dist)))
+    lines.append('{:<10} {:>10} {:>10}'.format(
+        'phase', 'time (ms)', 'tool calls'))
+    for phase, result in results['phases'].items():
+        lines.append('{:<10} {:>10.2f} {:>10}'.format(
+            phase, result['time'] * 1000, result['hook_tools']))
+    calls = results['calls']
+    lines.append('{replayed} hook tool calls replayed of {recorded} recorded '
+                 '({handlers} by the reactive handlers)'.format(**calls))
+    for kind in ('missing', 'extra'):
+        for call in calls[kind]:
+            lines.append('{} call: {} x{}'.format(
+                kind, ' '.join(call['args']), call['count']))
+    state = results['state']
+    for kind in ('missing', 'extra'):
+        if state['flags'][kind]:
+            lines.append('{} flags: {}'.format(
+                kind, ', '.join(state['flags'][kind])))
+    if state['kv']:
+        lines.append('changed keys: {}'.format(', '.join(state['kv'])))
+    if state['snapshots']:
+        lines.append('changed snapshots: {}'.format(
+            ', '.join(state['snapshots'])))
+    if state['notices']:
+        lines.append('deferred events differ')
+    if results.get('profile'):
+        lines.append(results['profile'])
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recording',
+                        help='Recording file written with ORI_RECORD')
+    parser.add_argument('--index', type=int, default=-1,
+                        help='Which recorded hook in the file to replay '
+                             '(default: the last one)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the replay with cProfile')
+    parser.add_argument('--json', action='store_true',
+                        help='Output the results as JSON')
+    opts = parser.parse_args(args)
+    results = replay(load_recording(opts.recording, opts.index),
+                     profile=opts.profile)
+    if opts.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
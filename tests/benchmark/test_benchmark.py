@@ -0,0 +1,59 @@
+from unittest.mock import patch
+
+import benchmark
+from benchmark import format_results, main, run_benchmark
+
+
+def test_benchmark():
+    results = run_benchmark(endpoints=4, relations=2, units=3, repeat=1)
+    assert set(results['phases']) == {'load', 'startup', 'flags',
+                                      'shutdown'}
+    for result in results['phases'].values():
+        assert result['time'] > 0
+        assert result['peak_memory'] > 0
+    assert results['phases']['load']['hook_tools'] == {}
+    assert results['phases']['startup']['hook_tools'] == {
+        'relation-ids': 4,
+        'relation-list': 8,
+        'relation-get': 8,
+    }
+    assert results['phases']['flags']['hook_tools'] == {'relation-get': 8}
+    assert 'startup' in format_results(results)
+
+
+def test_benchmark_in_process():
+    fresh = run_benchmark(endpoints=4, relations=2, units=3, repeat=2)
+    reused = run_benchmark(endpoints=4, relations=2, units=3, repeat=2,
+                           in_process=True)
+    assert reused['parameters']['in_process']
+    for phase in ('load', 'startup', 'flags', 'shutdown'):
+        assert (reused['phases'][phase]['hook_tools'] ==
+                fresh['phases'][phase]['hook_tools'])
+
+
+def test_benchmark_relation_hook(capsys):
+    main(['--endpoints', '4', '--units', '3', '--repeat', '1',
+          '--hook', 'ep1-relation-changed', '--json'])
+    assert '"ep1-relation-changed"' in capsys.readouterr().out
+
+
+def test_benchmark_scale():
+    # Managing the flags shouldn't cost more with more units. The rest of
+    # startup still snapshots every unit of each relation for the changed
+    # flags, so its time and memory grow with the number of units, but it
+    # shouldn't take any more hook tool calls to do so.
+    small, large = (run_benchmark(endpoints=2, units=units, repeat=1)
+                    for units in (1000, 10000))
+    assert (small['phases']['startup']['hook_tools'] ==
+            large['phases']['startup']['hook_tools'])
+    small, large = small['phases']['flags'], large['phases']['flags']
+    assert small['hook_tools'] == large['hook_tools']
+    assert large['peak_memory'] < small['peak_memory'] * 2
+
+
+def test_benchmark_without_reset_peak():
+    # As on Python 3.8, where tracemalloc can't reset the peak.
+    with patch.object(benchmark, '_reset_peak', None):
+        results = run_benchmark(endpoints=4, relations=2, units=3, repeat=1)
+    for result in results['phases'].values():
+        assert result['peak_memory'] > 0
@@ -0,0 +1,74 @@
+import os
+import sys
+from unittest.mock import patch
+
+from charms.unit_test import patch_reactive
+
+from benchmark import (
+    _hook_env,
+    run_hook,
+    synthetic_metadata,
+    synthetic_relations,
+)
+from replay import format_results, load_recording, main, replay
+
+
+def record_hook(hook, state_dir, runs=2):
+    metadata = synthetic_metadata(4)
+    relations = synthetic_relations(metadata, 1, 3)
+    env = dict(_hook_env(hook, relations),
+               ORI_RECORD='1',
+               UNIT_STATE_DB=str(state_dir / '.unit-state.db'))
+    sys_modules = sys.modules.copy()
+    try:
+        patch_reactive()
+        with patch.dict(os.environ, env):
+            for _ in range(runs):
+                sys.modules.pop('ops_reactive_interface', None)
+                run_hook(metadata, relations, hook, state_dir)
+            import ops_reactive_interface as ori
+            return state_dir / ori.RECORDING_FILE
+    finally:
+        sys.modules.clear()
+        sys.modules.update(sys_modules)
+
+
+def test_replay(tmp_path):
+    recording_file = record_hook('ep1-relation-changed', tmp_path)
+    recording = load_recording(recording_file)
+    assert recording['hook'] == 'ep1-relation-changed'
+    assert recording['env']['JUJU_RELATION'] == 'ep1'
+    assert recording['state_before']['snapshots']
+    tools = {call['args'][0] for call in recording['calls']}
+    assert tools == {'relation-ids', 'relation-list', 'relation-get'}
+
+    results = replay(recording)
+    assert set(results['phases']) == {'load', 'startup', 'shutdown'}
+    assert results['calls']['replayed'] == len(recording['calls'])
+    assert results['calls']['missing'] == []
+    assert results['calls']['extra'] == []
+    assert results['state'] == {
+        'flags': {'missing': [], 'extra': []},
+        'kv': [],
+        'snapshots': [],
+        'notices': False,
+    }
+    assert 'startup' in format_results(results)
+
+    # Differences from the recording are reported.
+    recording['calls'].append(dict(recording['calls'][0],
+                                   args=['is-leader', '--format=json']))
+    recording['state_after']['flags'].append('endpoint.ep9.joined')
+    results = replay(recording)
+    assert results['calls']['missing'] == [{
+        'args': ['is-leader', '--format=json'], 'input': None, 'count': 1}]
+    assert results['state']['flags']['missing'] == ['endpoint.ep9.joined']
+    assert 'missing flags: endpoint.ep9.joined' in format_results(results)
+
+
+def test_replay_main(tmp_path, capsys):
+    recording_file = record_hook('update-status', tmp_path, runs=1)
+    main([str(recording_file), '--profile'])
+    output = capsys.readouterr().out
+    assert 'hook update-status' in output
+    assert 'cumulative' in output
@@ -1,37 +1,28 @@
 from hashlib import md5
 
-from ops.framework import (
-    Object,
-    StoredState,
-)
+from ops.framework import StoredState
+from ops_reactive_interface_helpers import InterfaceAPI
 
 
-class ORITest(Object):
+class ORITest(InterfaceAPI):
     state = StoredState()
 
     def __init__(self, charm, relation_name):
         super().__init__(charm, relation_name)
-        self.charm = charm
-        self.relation_name = relation_name
         self.state.set_default(hash=None)
 
-    @property
-    def relations(self):
-        return self.charm.model.relations[self.relation_name]
-
     def send(self, value):
         for relation in self.relations:
             relation.data[self.charm.app]['sent'] = value
 
     @property
     def received(self):
-        return [relation.data[relation.app]['sent']
-                for relation in self.relations
-                if relation.data.get(relation.app, {}).get('sent')]
+        return [value for _, _, value
+                in self.iter_remote_data('sent', units=False)]
 
     @property
     def is_received(self):
-        return len(self.received) > 0
+        return self.any_remote_data('sent', units=False)
 
     @property
     def is_changed(self):
@@ -1,3 +1,5 @@
+import os
+import sqlite3
 import sys
 from pathlib import Path
 from unittest.mock import patch
@@ -8,15 +10,16 @@ import yaml
 from ops.charm import CharmBase
 from ops.testing import Harness
 
-from charms.unit_test import patch_reactive
+from charms.unit_test import flags, patch_reactive
 
 
 @pytest.fixture
-def harness():
+def harness(tmp_path):
     charm_dir = Path(__file__).parents[1] / 'charms' / 'reactive-charm'
     metadata_file = charm_dir / 'metadata.yaml'
     sys_modules = sys.modules.copy()
     patch_reactive()
+    flags.clear()
     harness = None
     try:
         import ops_reactive_interface as ori
@@ -27,10 +30,31 @@ def harness():
         harness = Harness(CharmBase, meta=metadata)
         harness._charm_dir = charm_dir
         harness.begin()
-        with patch.object(ori.InterfaceAPIFactory, '_charm', harness.charm):
-            yield harness
+        state_db = str(tmp_path / '.unit-state.db')
+        with patch.dict(os.environ, {'UNIT_STATE_DB': state_db}):
+            with patch.object(ori.InterfaceAPIFactory, '_charm',
+                              harness.charm):
+                yield harness
     finally:
         if harness:
             harness.cleanup()
         sys.modules.clear()
         sys.modules.update(sys_modules)
+
+
+@pytest.fixture
+def built_charm(harness, tmp_path):
+    # Lets the factory build its own charm, on a real state database, rather
+    # than using the harness's charm.
+    import ops_reactive_interface as ori
+    from charmhelpers.core import unitdata
+    IAF = ori.InterfaceAPIFactory
+    conn = sqlite3.connect(str(tmp_path / 'charm-state.db'))
+    try:
+        with patch.object(unitdata.kv(), 'conn', conn), \
+                patch.object(IAF, '_charm', None), \
+                patch.dict(os.environ, {'JUJU_VERSION': '3.6.2',
+                                        'JUJU_UNIT_NAME': 'test/0'}):
+            yield IAF
+    finally:
+        conn.close()
@@ -1,10 +1,15 @@
+import gc
+import json
 import os
-from unittest.mock import patch, Mock
+import subprocess
+import sys
+from functools import wraps
+from unittest.mock import call, patch, Mock
 from charms.unit_test import MockKV
 
 import pytest
 
-from ops import CharmBase, Handle, Object
+from ops import CharmBase, Handle, JujuVersion, Object
 
 
 def test_without_reactive():
@@ -14,6 +19,34 @@ def test_without_reactive():
 
 MockKV.conn = Mock()
 
+# Maximum time, in microseconds, for importing the module (not including
+# charms.reactive and charmhelpers, which are already imported in a hook).
+IMPORT_BUDGET = 50000
+
+
+def test_import_time():
+    script = '\n'.join([
+        'import json, sys',
+        'from charms.unit_test import patch_reactive',
+        'patch_reactive()',
+        'import charmhelpers.core.unitdata',
+        'import ops_reactive_interface',
+        'print(json.dumps(sorted(sys.modules)))',
+    ])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                            capture_output=True, text=True, check=True)
+    modules = json.loads(result.stdout)
+    assert not [name for name in modules
+                if name.split('.')[0] in ('ops', 'yaml')]
+    # Each line is "import time: {self} | {cumulative} | {module}".
+    for line in result.stderr.splitlines():
+        timings = line.partition(':')[2].split('|')
+        if timings[-1].strip() == 'ops_reactive_interface':
+            assert int(timings[1]) < IMPORT_BUDGET
+            break
+    else:
+        pytest.fail('Import time not reported')
+
 
 @pytest.mark.dependency()
 def test_load(harness):
@@ -31,17 +64,127 @@ def test_load(harness):
     assert give is not take
 
 
-def test_create_charm(harness):
+def test_from_flag(harness):
     import ops_reactive_interface as ori
+    from ori_test import ORITest
+    from charms.reactive import set_flag
     IAF = ori.InterfaceAPIFactory
-    IAF._charm = None
+
+    class Custom(ORITest):
+        managed_flags = ('{relation_name}-ready',)
+        flag_prefixes = ('custom.{relation_name}.',)
+
+    IAF.load()
+    IAF._bindings['give'] = Custom
+    IAF._relation_apis.pop('give', None)
+    IAF._index_flags()
+    for flag in ('endpoint.give.created', 'endpoint.give.received',
+                 'give.available', 'give-ready', 'custom.give.ready',
+                 'endpoint.give', 'endpoint.take.joined', 'other.flag',
+                 'unknown'):
+        set_flag(flag)
+
+    with patch.object(ori, 'is_flag_set', wraps=ori.is_flag_set) as checked:
+        for flag in ('endpoint.give.created', 'endpoint.give.received',
+                     'give.available', 'give-ready', 'custom.give.ready',
+                     'endpoint.give'):
+            assert isinstance(IAF.from_flag(flag), Custom)
+        assert isinstance(IAF.from_flag('endpoint.take.joined'), ORITest)
+        assert IAF.from_flag('endpoint.take.changed') is None
+        assert IAF.from_flag('endpoint.take') is None
+        # Flags which don't belong to any endpoint aren't checked.
+        assert checked.call_count == 9
+        assert IAF.from_flag('other.flag') is None
+        assert IAF.from_flag('unknown') is None
+        assert IAF.from_flag('endpoint.other.joined') is None
+        assert IAF.from_flag('endpoint.other') is None
+        assert checked.call_count == 9
+    assert IAF._flag_index['give.available'] == 'give'
+    assert IAF._flag_index['other.flag'] is None
+
+
+def test_context(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = ori.InterfaceAPIFactory
+    IAF.load()
+    IAF.from_name('give')
+    IAF.flag_stats['changed'] = 1
+    registry = IAF._registry
+    classes = dict(IAF._classes)
+    assert IAF._relation_apis and classes
+
+    # Registering again is a no-op until the hook has been shut down.
+    with patch.object(hookenv, 'atstart') as atstart, \
+            patch.object(hookenv, 'atexit') as atexit:
+        IAF.register()
+        assert not atstart.called
+        IAF._registered = False
+        IAF.create_context()
+        assert atstart.call_args_list == [call(IAF._startup)]
+        assert atexit.call_args_list == [call(IAF._shutdown)]
+
+    with IAF.context():
+        assert IAF._relation_apis == {}
+        assert IAF._bindings == {}
+        assert IAF._charm is None
+        assert IAF.flag_stats == {'changed': 0, 'skipped': 0}
+        assert IAF.deferred_stats['oldest_age'] is None
+        assert IAF._registry is registry
+        assert IAF._classes == classes
+        IAF._charm = harness.charm
+        with patch.object(ori, '_load_entry_point') as load_ep:
+            assert IAF.load()['classes'] == 0
+        assert not load_ep.called
+        assert set(IAF._bindings) == {'give', 'take', 'share'}
+    assert IAF._bindings == {}
+
+    IAF.dispose()
+    assert IAF._registry is None
+    assert IAF._classes == {}
+
+
+def test_context_aborted_hook(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = ori.InterfaceAPIFactory
+
+    def add(callbacks):
+        return lambda callback: callbacks.append((callback, (), {}))
+
+    atstart, atexit = [], []
+    with patch.object(hookenv, '_atstart', atstart), \
+            patch.object(hookenv, '_atexit', atexit), \
+            patch.object(hookenv, 'atstart', side_effect=add(atstart)), \
+            patch.object(hookenv, 'atexit', side_effect=add(atexit)):
+        IAF._registered = False
+        IAF.register()
+        IAF.load()
+        # The reactive framework drops the startup once it has run.
+        atstart.clear()
+        IAF._startup()
+        # A handler raised, so the reactive framework never ran the shutdown,
+        # which is still pending, but the next hook still needs its startup.
+        IAF.create_context()
+        assert atstart == [(IAF._startup, (), {})]
+        assert atexit == [(IAF._shutdown, (), {})]
+
+        # Nothing is added if the hook aborted before it started, either.
+        IAF.create_context()
+        assert atstart == [(IAF._startup, (), {})]
+        assert atexit == [(IAF._shutdown, (), {})]
+
+
+def test_create_charm(built_charm):
+    import ops_reactive_interface as ori
+    IAF = built_charm
 
     with patch.object(ori, '_ModelBackend'):
-        with patch.object(ori, 'SQLiteStorage'):
-            with patch.object(CharmBase, 'on'):
-                charm = IAF._create_charm()
+        charm = IAF._create_charm()
     assert isinstance(charm, CharmBase)
     assert charm.meta.name == 'reactive-charm'
+    assert charm.handle.path == 'CharmBase'
+    assert isinstance(charm.framework._storage, ori._TrackedStorage)
 
 
 @pytest.mark.dependency(depends=['test_load'])
@@ -119,3 +262,1024 @@ def test_startup(harness):
     observer.called = None
     IAF._startup()
     assert observer.called == 'LeaderElectedEvent'
+
+
+def test_startup_is_changed(harness):
+    from ops_reactive_interface import InterfaceAPIFactory as IAF
+    from charmhelpers.core import hookenv
+    from ori_test import ORITest
+    evaluated = []
+
+    class Counted(ORITest):
+        @property
+        def is_changed(self):
+            evaluated.append(self.relation_name)
+            return ORITest.is_changed.fget(self)
+
+        @is_changed.setter
+        def is_changed(self, value):
+            ORITest.is_changed.fset(self, value)
+
+        def manage_flags(self):
+            pass
+
+    IAF.load()
+    for endpoint_name in list(IAF._bindings):
+        IAF._bindings[endpoint_name] = Counted
+        IAF._relation_apis.pop(endpoint_name, None)
+        IAF.from_name(endpoint_name)
+    hookenv.hook_name.return_value = 'config-changed'
+    with patch.object(IAF, '_emit_events'):
+        IAF._startup()
+    # Checking for the property doesn't evaluate it, so it's only evaluated
+    # once for each endpoint, to manage the .changed flag.
+    assert sorted(evaluated) == ['give', 'share', 'take']
+
+
+@pytest.mark.parametrize('hook_name, cleaned', [
+    ('upgrade-charm', True),
+    ('give-relation-broken', True),
+    ('my-db-relation-broken', True),
+    ('give-relation-changed', False),
+    ('my-db-relation-changed', False),
+    ('other-relation-broken', False),
+    ('config-changed', False),
+])
+def test_startup_gc(harness, hook_name, cleaned):
+    from ops_reactive_interface import InterfaceAPIFactory as IAF
+    from charmhelpers.core import hookenv
+    hookenv.hook_name.return_value = hook_name
+    IAF.load()
+    # The event names in the dispatch table use underscores, unlike the hook
+    # names of endpoints with hyphens in their names.
+    for kind in ('changed', 'broken'):
+        IAF._dispatch['my-db-relation-' + kind] = (
+            'my_db_relation_' + kind, 'my-db')
+    with patch.object(IAF, 'clean_stored_state') as clean, \
+            patch.object(IAF, '_emit_events'):
+        IAF._startup()
+    assert clean.called == cleaned
+
+
+def test_dispatch(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = ori.InterfaceAPIFactory
+    IAF.load()
+    charm = IAF._charm
+    IAF._charm.framework.reemit = Mock()
+    assert IAF._dispatch['share-relation-departed'] == (
+        'share_relation_departed', 'share')
+    assert IAF._dispatch['leader-settings-changed'] == (
+        'leader_settings_changed', None)
+    assert 'config-changed' not in IAF._dispatch
+    assert 'other-relation-changed' not in IAF._dispatch
+
+    observed = []
+
+    class Observer(Object):
+        def record(self, event):
+            observed.append(type(event).__name__)
+
+    observer = Observer(charm, 'observer')
+    for event in (charm.on.leader_settings_changed,
+                  charm.on.give_relation_departed,
+                  charm.on.give_relation_broken,
+                  charm.on.share_relation_joined):
+        charm.framework.observe(event, observer.record)
+
+    rel_id = harness.add_relation('give', 'other')
+    harness.add_relation_unit(rel_id, 'other/0')
+    env = {'JUJU_RELATION': 'give',
+           'JUJU_VERSION': '3.6.2',
+           'JUJU_RELATION_ID': str(rel_id),
+           'JUJU_REMOTE_APP': 'other',
+           'JUJU_REMOTE_UNIT': 'other/0'}
+    with patch.dict(os.environ, env), \
+            patch.object(ori, '_resolve_event_args',
+                         wraps=ori._resolve_event_args) as resolve:
+        for hook_name in ('leader-settings-changed',
+                          'give-relation-departed',
+                          'give-relation-broken',
+                          'config-changed'):
+            hookenv.hook_name.return_value = hook_name
+            departing = {'JUJU_DEPARTING_UNIT': 'other/0'}
+            with patch.dict(os.environ, departing
+                            if hook_name.endswith('departed') else {}):
+                IAF._emit_hook_event()
+    assert observed == ['LeaderSettingsChangedEvent',
+                        'RelationDepartedEvent',
+                        'RelationBrokenEvent']
+    # The way to build the event arguments is only worked out once.
+    assert resolve.call_count == 1
+
+
+def test_registry(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    from ori_test import ORITest
+    IAF = ori.InterfaceAPIFactory
+
+    def reload():
+        # Drop the previous instances so they can be recreated.
+        IAF._registry = None
+        IAF._relation_apis.clear()
+        gc.collect()
+        IAF.load()
+
+    registry_path = ori._state_dir() / ori.REGISTRY_FILE
+    assert not registry_path.exists()
+    IAF.load()
+    assert registry_path.exists()
+    assert IAF._registry['entry_points']['requires'] == {
+        'ori-test': 'ori_test:ORITest',
+    }
+
+    # Subsequent hooks use the cached registry without scanning.
+    with patch.object(ori, '_scan_entry_points') as scan:
+        reload()
+    assert not scan.called
+    assert isinstance(IAF.from_name('give'), ORITest)
+
+    # Changes to the installed distributions cause a rescan.
+    with patch.object(ori, '_site_fingerprint', return_value=[['x', 1]]):
+        with patch.object(ori, '_scan_entry_points',
+                          wraps=ori._scan_entry_points) as scan:
+            reload()
+    assert scan.called
+
+    # As does upgrading the charm.
+    hookenv.hook_name.return_value = 'upgrade-charm'
+    with patch.object(ori, '_scan_entry_points',
+                      wraps=ori._scan_entry_points) as scan:
+        reload()
+    assert scan.called
+
+    # Stale entries which can no longer be loaded also cause a rescan.
+    hookenv.hook_name.return_value = 'config-changed'
+    registry = json.loads(registry_path.read_text())
+    registry['entry_points']['requires']['ori-test'] = 'ori_test:Missing'
+    registry_path.write_text(json.dumps(registry))
+    reload()
+    assert isinstance(IAF.from_name('take'), ORITest)
+    assert 'Missing' not in registry_path.read_text()
+
+
+def test_metadata_cache(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = ori.InterfaceAPIFactory
+    metadata = hookenv.metadata.return_value
+
+    metadata_path = ori._state_dir() / ori.METADATA_FILE
+    assert not metadata_path.exists()
+    IAF._metadata = None
+    assert IAF._get_metadata() == metadata
+    assert hookenv.metadata.call_count == 1
+    assert metadata_path.exists()
+
+    # Subsequent hooks use the cached metadata without parsing it.
+    IAF._metadata = None
+    assert IAF._get_metadata() == metadata
+    assert hookenv.metadata.call_count == 1
+
+    # Changes to the metadata file cause it to be parsed again.
+    IAF._metadata = None
+    with patch.object(ori, '_metadata_fingerprint', return_value=[1, 2]):
+        assert IAF._get_metadata() == metadata
+    assert hookenv.metadata.call_count == 2
+
+    # As does upgrading the charm.
+    IAF._metadata = None
+    hookenv.hook_name.return_value = 'upgrade-charm'
+    assert IAF._get_metadata() == metadata
+    assert hookenv.metadata.call_count == 3
+
+
+def test_metadata_cache_primes_charmhelpers(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = ori.InterfaceAPIFactory
+    metadata = hookenv.metadata.return_value
+    IAF._metadata = None
+    IAF._get_metadata()
+
+    # Mirror charmhelpers' @cached, which keys its cache on the undecorated
+    # function.
+    def _metadata():
+        return {'parsed': True}
+
+    @wraps(_metadata)
+    def cached_metadata():
+        key = json.dumps((_metadata, (), {}), sort_keys=True, default=str)
+        if key not in cache:
+            cache[key] = _metadata()
+        return cache[key]
+
+    cache = {}
+    IAF._metadata = None
+    with patch.object(hookenv, 'metadata', cached_metadata), \
+            patch.object(hookenv, 'cache', cache):
+        assert IAF._get_metadata() == metadata
+        # The reactive framework's later lookup doesn't parse the file.
+        assert hookenv.metadata() == metadata
+
+        # Nothing is replaced if charmhelpers has already parsed it.
+        cache.clear()
+        assert hookenv.metadata() == {'parsed': True}
+        IAF._metadata = None
+        assert IAF._get_metadata() == metadata
+        assert hookenv.metadata() == {'parsed': True}
+
+
+def test_lazy(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    from ori_test import ORITest
+    IAF = ori.InterfaceAPIFactory
+    fw = IAF._charm.framework
+    fw.reemit = Mock()
+
+    with patch.object(IAF, 'lazy', True):
+        IAF.load()
+        assert set(IAF._bindings) == {'give', 'take', 'share'}
+        assert not IAF._relation_apis
+
+        hookenv.hook_name.return_value = 'config-changed'
+        assert IAF._eager_endpoints() == set()
+        hookenv.hook_name.return_value = 'take-relation-joined'
+        assert IAF._eager_endpoints() == {'take'}
+        hookenv.hook_name.return_value = 'leader-elected'
+        assert IAF._eager_endpoints() == {'give', 'take', 'share'}
+
+        hookenv.hook_name.return_value = 'config-changed'
+        fw._storage.save_notice('CharmBase/on/share_relation_changed[1]',
+                                'CharmBase/ORITest[share]',
+                                '_on_changed')
+        assert IAF._eager_endpoints() == {'share'}
+        fw._storage.save_notice('CharmBase/on/config_changed[2]',
+                                'CharmBase/Other[thing]',
+                                '_on_config_changed')
+        assert IAF._eager_endpoints() == {'give', 'take', 'share'}
+        fw._storage.drop_notice('CharmBase/on/config_changed[2]',
+                                'CharmBase/Other[thing]',
+                                '_on_config_changed')
+
+        hookenv.hook_name.return_value = 'config-changed'
+        with patch.object(IAF, '_has_api', return_value=False):
+            IAF._startup()
+        assert set(IAF._relation_apis) == {'share'}
+        IAF._startup()
+        # ORITest manages flags, so every endpoint ends up being built, but
+        # only once each.
+        assert set(IAF._relation_apis) == {'give', 'take', 'share'}
+        give = IAF.from_name('give')
+        assert isinstance(give, ORITest)
+        assert IAF.from_name('give') is give
+        assert IAF.from_name('unknown') is None
+
+
+def test_load_stats(harness):
+    import ops_reactive_interface as ori
+    from ori_test import ORITest
+    IAF = ori.InterfaceAPIFactory
+
+    assert IAF.load() == {'entry_points': 3, 'classes': 1, 'instances': 3}
+
+    meta = {
+        'name': 'many',
+        'provides': {'a': {'interface': 'ori-test'},
+                     'b': {'interface': 'other'}},
+        'requires': {'c': {'interface': 'ori-test'},
+                     'd': {'interface': 'ori-test'},
+                     'e': {'interface': 'ori-test'}},
+    }
+    IAF.load_stats = dict.fromkeys(IAF.load_stats, 0)
+    IAF._classes = {}
+    with patch.object(ori, '_load_entry_point',
+                      wraps=ori._load_entry_point) as load_ep:
+        bindings = IAF._resolve(meta, IAF._get_registry())
+    assert bindings == {'a': ORITest, 'c': ORITest, 'd': ORITest,
+                        'e': ORITest}
+    assert load_ep.call_count == 1
+    assert IAF.load_stats == {'entry_points': 3, 'classes': 1,
+                              'instances': 0}
+
+    # Imported classes are reused.
+    IAF.load_stats = dict.fromkeys(IAF.load_stats, 0)
+    with patch.object(ori, '_load_entry_point') as load_ep:
+        assert IAF._resolve(meta, IAF._get_registry()) == bindings
+    assert not load_ep.called
+    assert IAF.load_stats['classes'] == 0
+
+
+def test_topology(harness):
+    from ops_reactive_interface import InterfaceAPIFactory as IAF
+    IAF.load()
+    backend = harness._backend
+
+    with patch.object(backend, 'relation_ids',
+                      wraps=backend.relation_ids) as relation_ids:
+        IAF._snapshot_topology()
+        assert relation_ids.call_count == 3
+        assert IAF.topology('give') == ()
+        assert IAF.topology('take') == ()
+        assert relation_ids.call_count == 3
+
+    rel_id = harness.add_relation('give', 'other')
+    assert IAF.topology('give') == ((rel_id, 0),)
+    harness.add_relation_unit(rel_id, 'other/0')
+    harness.add_relation_unit(rel_id, 'other/1')
+    assert IAF.topology('give') == ((rel_id, 2),)
+    assert IAF.topology('take') == ()
+
+
+def test_tracked_storage(harness):
+    import sqlite3
+    import ops_reactive_interface as ori
+    from ops.storage import NoSnapshotError, SQLiteStorage
+
+    conn = sqlite3.connect(':memory:')
+
+    def tracked_storage():
+        # Each hook starts after the previous one was committed.
+        conn.commit()
+        store = SQLiteStorage(':memory:')
+        store.close()
+        store._db = conn
+        store._setup()
+        return ori._TrackedStorage(store)
+
+    def rows():
+        return dict(conn.execute('SELECT handle, data FROM snapshot'))
+
+    store = tracked_storage()
+    store.save_snapshot('a', {'x': 1})
+    store.save_snapshot('b', {'y': 2})
+    assert store.load_snapshot('a') == {'x': 1}
+    assert rows() == {}
+    store.commit()
+    assert set(rows()) == {'a', 'b'}
+    assert store.stats['rows'] == 2
+    # The final commit is left to unitdata.
+    assert conn.in_transaction
+
+    # Saving a snapshot without changing it doesn't write it.
+    store = tracked_storage()
+    assert store.load_snapshot('a') == {'x': 1}
+    store.save_snapshot('a', {'x': 1})
+    store.save_snapshot('b', {'y': 2})
+    store.drop_snapshot('c')
+    store.commit()
+    assert store.stats == {'rows': 0, 'bytes': 0, 'unchanged': 3}
+
+    store = tracked_storage()
+    store.save_snapshot('a', {'x': 2})
+    store.drop_snapshot('b')
+    with pytest.raises(NoSnapshotError):
+        store.load_snapshot('b')
+    assert list(store.list_snapshots()) == ['a']
+    assert store.stats['rows'] == 2
+    assert store.stats['bytes'] == len(rows()['a'])
+    store.commit()
+    assert store.stats['rows'] == 2
+
+
+def test_clean_stored_state(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import unitdata
+    from ops.framework import StoredState
+    IAF = ori.InterfaceAPIFactory
+    IAF.load()
+    charm = IAF._charm
+    store = charm.framework._storage
+
+    # An instance from a previous version of the charm.
+    class Old(Object):
+        _stored = StoredState()
+
+    old = Old(charm, 'gone')
+    old._stored.foo = 'bar'
+    IAF.from_name('give').state.foo = 'bar'
+    charm.framework.commit()
+    store.save_snapshot('CharmBase/on/update_status[1]', {})
+    store.save_notice('CharmBase/on/update_status[1]', 'CharmBase/Old[gone]',
+                      '_on_update_status')
+    store.save_snapshot('CharmBase/on/update_status[2]', {})
+    store.save_notice('CharmBase/on/update_status[2]', 'CharmBase/Other',
+                      '_on_update_status')
+    kv = unitdata.kv()
+    kv.set(ori.OWNERS_KEY, kv.get(ori.OWNERS_KEY) + ['Old[gone]'])
+
+    footprint = IAF.stored_state_footprint()
+    assert footprint['Old[gone]']['snapshots'] == 1
+    assert footprint['Old[gone]']['notices'] == 1
+    assert footprint['Old[gone]']['bytes'] > 0
+    assert footprint['ORITest[give]']['snapshots'] == 1
+    assert footprint['on']['snapshots'] == 2
+
+    removed = IAF.clean_stored_state()
+    assert removed['snapshots'] == 2
+    assert removed['notices'] == 1
+    footprint = IAF.stored_state_footprint()
+    assert 'Old[gone]' not in footprint
+    assert footprint['ORITest[give]']['snapshots'] == 1
+    assert footprint['on']['snapshots'] == 1
+    assert list(store.notices()) == [
+        ('CharmBase/on/update_status[2]', 'CharmBase/Other',
+         '_on_update_status'),
+    ]
+    assert kv.get(ori.OWNERS_KEY) == [
+        'ORITest[give]', 'ORITest[share]', 'ORITest[take]']
+    assert IAF.clean_stored_state() == {'snapshots': 0, 'notices': 0,
+                                        'bytes': 0}
+
+
+def test_fast_path(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    from charms.reactive import is_flag_set
+    IAF = ori.InterfaceAPIFactory
+    charm = IAF._charm
+    IAF._charm = None
+
+    def _create_charm():
+        IAF._charm = charm
+        return charm
+
+    hookenv.hook_name.return_value = 'update-status'
+    with patch.object(IAF, 'fast_path', True), \
+            patch.object(IAF, '_has_notices', return_value=False), \
+            patch.object(IAF, '_create_charm',
+                         side_effect=_create_charm) as create_charm:
+        assert IAF.load()['instances'] == 0
+        assert IAF._idle
+        IAF._startup()
+        IAF._shutdown()
+        assert not create_charm.called
+        assert not is_flag_set('endpoint.give.created')
+        assert set(IAF._changed_triggers) == {'give', 'take', 'share'}
+
+        # The charm is only built once an instance is requested.
+        assert IAF.from_name('give') is not None
+        assert create_charm.called
+        assert IAF.load_stats['instances'] == 1
+
+        # Any of these mean there's work to do.
+        IAF._relation_apis.clear()
+        for hook_name in ('upgrade-charm', 'leader-elected',
+                          'give-relation-changed'):
+            hookenv.hook_name.return_value = hook_name
+            assert IAF._has_work()
+        hookenv.hook_name.return_value = 'unbound-relation-changed'
+        assert not IAF._has_work()
+        IAF._has_notices.return_value = True
+        assert IAF._has_work()
+
+
+def test_instrument(built_charm):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = built_charm
+
+    with patch.object(IAF, 'instrument', True):
+        IAF._create_charm()
+    backend = IAF._backend
+    assert isinstance(backend, ori._InstrumentedBackend)
+
+    def _run(*args, **kwargs):
+        return {'relation-ids': ['give:1'], 'is-leader': True}[args[0]]
+
+    with patch.object(ori._ModelBackend, '_run', side_effect=_run):
+        with IAF._in_phase('automatic_flags', 'give'):
+            assert backend.relation_ids('give') == [1]
+        with IAF._in_phase('manage_flags', 'give'):
+            assert backend.is_leader()
+    assert [(c['tool'], c['args'], c['phase'], c['endpoint'])
+            for c in backend.calls] == [
+        ('relation-ids', ['give'], 'automatic_flags', 'give'),
+        ('is-leader', [], 'manage_flags', 'give'),
+    ]
+
+    hookenv.hook_name.return_value = 'update-status'
+    IAF._report_hook_tools()
+    message = hookenv.log.call_args[0][0]
+    assert '2 hook tool calls' in message
+    assert 'automatic_flags: relation-ids x1' in message
+    assert 'manage_flags: is-leader x1' in message
+    lines = (ori._state_dir() / ori.HOOK_TOOLS_FILE).read_text().splitlines()
+    assert len(lines) == 1
+    record = json.loads(lines[0])
+    assert record['hook'] == 'update-status'
+    assert record['calls'] == 2
+    assert record['phases']['manage_flags']['is-leader'][0] == 1
+    assert len(record['records']) == 2
+
+
+@pytest.mark.parametrize('instrument', [False, True])
+def test_save_logging(built_charm, instrument):
+    from charmhelpers.core import hookenv
+    IAF = built_charm
+    hookenv.hook_name.return_value = 'update-status'
+
+    # Logging runs juju-log, so nothing is logged unless instrumented.
+    with patch.object(IAF, 'instrument', instrument), \
+            patch.object(IAF, 'cache', True):
+        IAF._create_charm()
+        hookenv.log.reset_mock()
+        IAF._save()
+    assert IAF.storage_stats['rows'] or IAF.storage_stats['unchanged']
+    messages = [c[0][0] for c in hookenv.log.call_args_list]
+    assert any('stored state rows' in message
+               for message in messages) == instrument
+    assert any('cache hit rate' in message
+               for message in messages) == instrument
+    # The stats themselves are always available.
+    assert set(IAF.cache_stats) >= {'hits', 'misses'}
+
+
+def test_cache(built_charm):
+    import ops_reactive_interface as ori
+    IAF = built_charm
+
+    with patch.object(IAF, 'cache', True), \
+            patch.object(IAF, 'instrument', True):
+        IAF._create_charm()
+    backend = IAF._backend
+    assert isinstance(backend, ori._CachingBackend)
+    assert isinstance(backend, ori._InstrumentedBackend)
+    assert IAF.cache_stats is backend.cache_stats
+
+    data = {'test/0': {'foo': 'bar'}, 'other/0': {'baz': 'qux'}}
+
+    def _run(*args, **kwargs):
+        if args[0] == 'relation-get':
+            return data[args[4]]
+        if args[0] == 'relation-set':
+            data['test/0'] = {'foo': 'new'}
+            return
+        return {'relation-ids': ['give:1']}[args[0]]
+
+    with patch.object(ori._ModelBackend, '_run', side_effect=_run):
+        for _ in range(3):
+            assert backend.relation_ids('give') == [1]
+            assert backend.relation_get(1, 'test/0', False) == {'foo': 'bar'}
+            assert backend.relation_get(1, 'other/0', False) == {
+                'baz': 'qux'}
+        backend.relation_get(1, 'test/0', False)['foo'] = 'changed'
+        assert backend.relation_get(1, 'test/0', False) == {'foo': 'bar'}
+        backend.relation_set(1, 'foo', 'new', False)
+        assert backend.relation_get(1, 'test/0', False) == {'foo': 'new'}
+        assert backend.relation_get(1, 'other/0', False) == {'baz': 'qux'}
+    assert [c['tool'] for c in backend.calls] == [
+        'relation-ids', 'relation-get', 'relation-get', 'relation-set',
+        'relation-get',
+    ]
+    assert backend.cache_stats == {'hits': 9, 'misses': 4, 'prefetched': 0,
+                                   'invalidated': 1}
+    assert backend.hit_rate() == 9 / 13
+
+
+def test_prefetch(harness):
+    import threading
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = ori.InterfaceAPIFactory
+    IAF.load()
+    IAF._charm = None
+    hookenv.hook_name.return_value = 'give-relation-changed'
+
+    release = threading.Event()
+    threads = set()
+
+    def _run(*args, **kwargs):
+        release.wait(5)
+        threads.add(threading.current_thread())
+        if args[0] == 'relation-get':
+            return {'sent': args[4]}
+        return {
+            'relation-ids': ['give:1'],
+            'relation-list': ['other/0'],
+        }[args[0]]
+
+    with patch.object(IAF, 'prefetch', True), \
+            patch.object(IAF, 'instrument', True), \
+            patch.object(ori._ModelBackend, '_run', side_effect=_run), \
+            patch.dict(os.environ, {'JUJU_VERSION': '3.6.2',
+                                    'JUJU_UNIT_NAME': 'test/0',
+                                    'JUJU_RELATION_ID': 'give:1',
+                                    'JUJU_REMOTE_UNIT': 'other/0',
+                                    'JUJU_REMOTE_APP': 'other'}):
+        IAF._prefetch()
+        backend = IAF._backend
+        assert isinstance(backend, ori._CachingBackend)
+        assert len(backend.prefetching) == 4
+        # The calls are made in the background.
+        release.set()
+        assert backend.relation_ids('give') == [1]
+        assert backend.relation_list(1) == ['other/0']
+        assert backend.relation_get(1, 'other/0', False) == {
+            'sent': 'other/0'}
+        assert backend.relation_get(1, 'other', True) == {'sent': 'other'}
+    assert threading.main_thread() not in threads
+    assert backend.cache_stats == {'hits': 0, 'misses': 0, 'prefetched': 4,
+                                   'invalidated': 0}
+    assert {(c['tool'], c['phase']) for c in backend.calls} == {
+        ('relation-ids', 'prefetch'),
+        ('relation-list', 'prefetch'),
+        ('relation-get', 'prefetch'),
+    }
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_prefetch_hook(built_charm, lazy):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = built_charm
+    hookenv.hook_name.return_value = 'give-relation-changed'
+
+    def _run(*args, **kwargs):
+        if args[0] == 'relation-ids':
+            return ['give:1'] if args[1] == 'give' else []
+        if args[0] == 'relation-list':
+            return ['other/0']
+        if args[0] == 'relation-get':
+            return {'sent': args[4]}
+        if args[0] == 'is-leader':
+            return True
+
+    with patch.object(IAF, 'prefetch', True), \
+            patch.object(IAF, 'lazy', lazy), \
+            patch.object(ori._ModelBackend, '_run', side_effect=_run), \
+            patch.dict(os.environ, {'JUJU_RELATION': 'give',
+                                    'JUJU_RELATION_ID': 'give:1',
+                                    'JUJU_REMOTE_UNIT': 'other/0',
+                                    'JUJU_REMOTE_APP': 'other'}):
+        IAF.load()
+        IAF._startup()
+    assert IAF.cache_stats['prefetched'] > 0
+
+
+def test_buffer_writes(built_charm):
+    import ops_reactive_interface as ori
+    IAF = built_charm
+
+    with patch.object(IAF, 'buffer_writes', True), \
+            patch.object(IAF, 'cache', True), \
+            patch.object(IAF, 'instrument', True):
+        IAF._create_charm()
+    backend = IAF._backend
+    assert isinstance(backend, ori._BufferedBackend)
+    assert IAF.write_stats is backend.write_stats
+
+    data = {'test/0': {'foo': 'bar', 'baz': 'qux'}, 'test': {}}
+
+    def _run(*args, **kwargs):
+        if args[0] == 'relation-get':
+            return data[args[4]]
+
+    with patch.object(ori._ModelBackend, '_run', side_effect=_run):
+        backend.relation_set(1, 'foo', 'one', False)
+        backend.relation_set(1, 'foo', 'two', False)
+        backend.relation_set(1, 'baz', '', False)
+        backend.relation_set(1, 'app', 'data', True)
+        backend.relation_set(2, 'foo', 'bar', False)
+        assert backend.relation_get(1, 'test/0', False) == {'foo': 'two'}
+        assert backend.relation_get(1, 'test', True) == {'app': 'data'}
+        assert [c['tool'] for c in backend.calls] == ['relation-get'] * 2
+        with IAF._in_phase('shutdown'):
+            backend.flush()
+    sets = [(c['args'], c['phase']) for c in backend.calls
+            if c['tool'] == 'relation-set']
+    assert sets == [
+        (['-r', '1', '--file', '-'], 'shutdown'),
+        (['-r', '1', '--app', '--file', '-'], 'shutdown'),
+        (['-r', '2', '--file', '-'], 'shutdown'),
+    ]
+    assert backend.pending == {}
+    assert backend.write_stats == {'writes': 5, 'relation_sets': 3}
+
+
+def test_buffer_writes_errors(built_charm):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = built_charm
+
+    # Application data can't be written on older versions of Juju.
+    with patch.object(IAF, 'buffer_writes', True), \
+            patch.dict(os.environ, {'JUJU_VERSION': '2.6.0'}):
+        IAF._create_charm()
+    backend = IAF._backend
+    assert backend._juju_version() == JujuVersion('2.6.0')
+    with pytest.raises(RuntimeError):
+        backend.relation_set(1, 'app', 'data', True)
+    assert backend.pending == {}
+
+    def _run(*args, **kwargs):
+        if args[2] == '1':
+            raise ori.ModelError('ERROR relation not found')
+
+    # Writes to a relation which has gone are dropped, with a warning.
+    backend.relation_set(1, 'foo', 'bar', False)
+    backend.relation_set(2, 'foo', 'bar', False)
+    hookenv.log.reset_mock()
+    with patch.object(ori._ModelBackend, '_run', side_effect=_run) as run:
+        backend.flush()
+    assert run.call_count == 2
+    assert backend.write_stats['relation_sets'] == 1
+    hookenv.log.assert_called_once_with(
+        'ops_reactive_interface: dropped buffered writes of foo to relation '
+        '1, which no longer exists', hookenv.WARNING)
+
+
+def test_trace(harness):
+    import ops_reactive_interface as ori
+    from charmhelpers.core import hookenv
+    IAF = ori.InterfaceAPIFactory
+    IAF._charm.framework.reemit = Mock()
+    hookenv.hook_name.return_value = 'config-changed'
+
+    with patch.object(IAF, 'trace', True), \
+            patch.object(IAF, '_save'):
+        IAF._registry = None
+        IAF.load()
+        IAF._startup()
+        IAF._shutdown()
+    lines = (ori._state_dir() / ori.TRACE_FILE).read_text().splitlines()
+    assert len(lines) == 1
+    record = json.loads(lines[0])
+    resource_spans, = record['resourceSpans']
+    scope_spans, = resource_spans['scopeSpans']
+    spans = scope_spans['spans']
+    assert len({span['traceId'] for span in spans}) == 1
+    by_id = {span['spanId']: span for span in spans}
+
+    def find(name, **attributes):
+        found = []
+        for span in spans:
+            values = {attr['key']: attr['value']['stringValue']
+                      for attr in span['attributes']}
+            if span['name'] == name and all(
+                    values.get(key) == value
+                    for key, value in attributes.items()):
+                found.append(span)
+        return found
+
+    root, = find('hook')
+    assert root['parentSpanId'] == ''
+    for span in spans:
+        assert int(span['startTimeUnixNano']) <= int(span['endTimeUnixNano'])
+        assert span is root or span['parentSpanId'] in by_id
+        assert find(span['name'], **{'juju.hook': 'config-changed'})
+    assert find('import')
+    load, = find('load')
+    load_class, = find('load_class', **{'juju.interface': 'ori-test'})
+    assert load_class['parentSpanId'] == load['spanId']
+    builds = find('build', **{'ori.class': 'ORITest'})
+    assert len(builds) == 3
+    assert all(build['parentSpanId'] == load['spanId'] for build in builds)
+    for endpoint in ('give', 'take', 'share'):
+        assert find('automatic_flags', **{'juju.endpoint': endpoint,
+                                          'juju.interface': 'ori-test'})
+        assert find('manage_flags', **{'juju.endpoint': endpoint})
+    for name in ('startup', 'reemit', 'emit', 'dispatch'):
+        assert find(name)
+
+    # Later hooks in the same process start from their own context, and
+    # don't include the import.
+    with patch.object(IAF, 'trace', True), \
+            patch.object(IAF, '_save'), \
+            patch.object(hookenv, 'atstart'), \
+            patch.object(hookenv, 'atexit'):
+        IAF.create_context()
+        start = IAF._hook_start
+        IAF._charm = harness.charm
+        IAF.load()
+        IAF._startup()
+        IAF._shutdown()
+    lines = (ori._state_dir() / ori.TRACE_FILE).read_text().splitlines()
+    assert len(lines) == 2
+    spans = json.loads(lines[1])['resourceSpans'][0]['scopeSpans'][0]['spans']
+    root, = find('hook')
+    assert int(root['startTimeUnixNano']) == start > ori._IMPORT_START
+    assert not find('import')
+    assert find('dispatch')
+
+
+def test_apply_flags(harness):
+    from ops_reactive_interface import InterfaceAPIFactory as IAF
+    from charms.reactive import (
+        clear_flag,
+        get_flags,
+        is_flag_set,
+        set_flag,
+    )
+    set_flag('endpoint.give.created')
+    set_flag('endpoint.give.joined')
+    set_flag.reset_mock()
+
+    IAF._queue_flag('endpoint.give.created', True)
+    IAF._queue_flag('endpoint.give.joined', False)
+    IAF._queue_flag('endpoint.give.changed', False)
+    IAF._queue_flag('endpoint.take.created', True)
+    get_flags.reset_mock()
+    IAF._apply_flags()
+    assert is_flag_set('endpoint.give.created')
+    assert not is_flag_set('endpoint.give.joined')
+    assert is_flag_set('endpoint.take.created')
+    assert IAF.flag_stats == {'changed': 2, 'skipped': 2}
+    assert set_flag.call_count == 1
+    assert clear_flag.call_count == 1
+    # One read, plus one after each change.
+    assert get_flags.call_count == 3
+    assert not IAF._pending_flags
+
+    get_flags.reset_mock()
+    IAF._queue_flag('endpoint.give.created', True)
+    IAF._queue_flag('endpoint.give.joined', False)
+    IAF._apply_flags()
+    assert IAF.flag_stats == {'changed': 0, 'skipped': 2}
+    assert get_flags.call_count == 1
+
+
+def test_reemit(harness):
+    import ops_reactive_interface as ori
+    IAF = ori.InterfaceAPIFactory
+    charm = IAF._charm
+    store = charm.framework._storage
+
+    class Observer(Object):
+        def __init__(self, parent, key):
+            super().__init__(parent, key)
+            self.deferring = True
+            self.seen = []
+            parent.framework.observe(parent.on.give_relation_changed,
+                                     self._on_changed)
+
+        def _on_changed(self, event):
+            if self.deferring:
+                event.defer()
+            else:
+                self.seen.append(event.relation.id)
+
+    observer = Observer(charm, 'give')
+    rel_id = harness.add_relation('give', 'other')
+    relation = charm.model.get_relation('give', rel_id)
+    for _ in range(3):
+        charm.on.give_relation_changed.emit(relation, relation.app)
+    other_id = harness.add_relation('give', 'another')
+    other = charm.model.get_relation('give', other_id)
+    charm.on.give_relation_changed.emit(other, other.app)
+    assert len(list(store.notices())) == 4
+
+    with patch.object(IAF, 'coalesce_deferred', True), \
+            patch.object(IAF, 'reemit_limit', 1):
+        IAF._reemit()
+    assert IAF.deferred_stats['coalesced'] == 2
+    assert IAF.deferred_stats['pending'] == 2
+    assert IAF.deferred_stats['reemitted'] == 1
+    assert IAF.deferred_stats['oldest_age'] >= 0
+    assert len(list(store.notices())) == 2
+    assert len(list(store.list_snapshots())) == 2
+    assert not observer.seen
+
+    observer.deferring = False
+    with patch.object(IAF, 'reemit_limit', 1):
+        IAF._reemit()
+    assert observer.seen == [rel_id]
+    assert len(list(store.notices())) == 1
+    IAF._reemit()
+    assert observer.seen == [rel_id, other_id]
+    assert not list(store.notices())
+    assert IAF.deferred_stats['pending'] == 1
+    IAF._reemit()
+    assert IAF.deferred_stats == {'pending': 0, 'coalesced': 0,
+                                  'reemitted': 0, 'oldest_age': None}
+
+
+def test_concurrent_flags(harness):
+    import threading
+    from ops_reactive_interface import InterfaceAPIFactory as IAF
+    from charms.reactive import is_flag_set
+    from ori_test import ORITest
+
+    threads = set()
+    changed_threads = []
+    read_threads = []
+
+    class Concurrent(ORITest):
+        concurrent_flags = True
+
+        @property
+        def is_changed(self):
+            changed_threads.append(threading.current_thread())
+            return ORITest.is_changed.fget(self)
+
+        @is_changed.setter
+        def is_changed(self, value):
+            ORITest.is_changed.fset(self, value)
+
+        def gather_flags(self):
+            threads.add(threading.current_thread())
+            return {'endpoint.{}.received'.format(self.relation_name):
+                    self.is_received}
+
+    IAF._bindings.update({'give': Concurrent, 'take': Concurrent,
+                          'share': ORITest})
+    rel_id = harness.add_relation('give', 'other')
+    harness.add_relation_unit(rel_id, 'other/0')
+    harness.update_relation_data(rel_id, 'other', {'sent': 'foo'})
+    # Without lazy mode, the instances already exist before the flags are
+    # managed.
+    for endpoint_name in IAF._bindings:
+        IAF.from_name(endpoint_name)
+    # The harness has already loaded the relation data, so drop it to have it
+    # read again.
+    harness.charm.model.relations._invalidate('give')
+    backend = harness.charm.model._backend
+    relation_get = backend.relation_get
+
+    def _relation_get(*args, **kwargs):
+        read_threads.append(threading.current_thread())
+        return relation_get(*args, **kwargs)
+
+    with patch.object(IAF, 'flag_workers', 2), \
+            patch.object(backend, 'relation_get', _relation_get):
+        IAF._manage_flags_concurrently()
+    # The properties are only evaluated once each, and they and the relation
+    # data reads they need are all in the workers.
+    assert len(changed_threads) == 2
+    assert read_threads
+    assert threading.main_thread() not in changed_threads + read_threads
+    assert list(IAF._pending_flags) == [
+        'endpoint.give.created',
+        'endpoint.give.joined',
+        'endpoint.give.changed',
+        'endpoint.give.received',
+        'endpoint.take.created',
+        'endpoint.take.joined',
+        'endpoint.take.changed',
+        'endpoint.take.received',
+        'endpoint.share.created',
+        'endpoint.share.joined',
+        'endpoint.share.changed',
+    ]
+    IAF._apply_flags()
+    assert len(threads) > 0
+    assert threading.main_thread() not in threads
+    for flag in ('created', 'joined', 'changed', 'received'):
+        assert is_flag_set('endpoint.give.' + flag)
+        assert not is_flag_set('endpoint.take.' + flag)
+    assert set(IAF._changed_triggers) == {'give', 'take', 'share'}
+
+
+def test_changed_trigger(harness):
+    from ops_reactive_interface import InterfaceAPIFactory as IAF
+    from charms.reactive import register_trigger
+    IAF.load()
+    IAF._snapshot_topology()
+    give = IAF.from_name('give')
+
+    register_trigger.reset_mock()
+    for _ in range(3):
+        for endpoint_name in IAF._bindings:
+            IAF._manage_automatic_flags(endpoint_name)
+    assert register_trigger.call_count == 3
+    callbacks = {call.kwargs['when_not']: call.kwargs['callback']
+                 for call in register_trigger.call_args_list}
+    assert set(callbacks) == {'endpoint.give.changed',
+                              'endpoint.take.changed',
+                              'endpoint.share.changed'}
+
+    rel_id = harness.add_relation('give', 'other')
+    harness.update_relation_data(rel_id, 'other', {'sent': 'foo'})
+    assert give.is_changed
+    callbacks['endpoint.give.changed']()
+    assert not give.is_changed
+
+    # Read-only properties are left alone.
+    class ReadOnly(Object):
+        is_changed = property(lambda self: True)
+
+    with patch.dict(IAF._relation_apis, {'give': ReadOnly(IAF._charm, 'ro')}):
+        callbacks['endpoint.give.changed']()
+
+    # As are classes without the property, which mustn't gain an attribute
+    # which looks like it.
+    untracked = Object(IAF._charm, 'untracked')
+    with patch.dict(IAF._relation_apis, {'give': untracked}):
+        callbacks['endpoint.give.changed']()
+        assert not hasattr(untracked, 'is_changed')
+        assert not IAF._has_api('give', 'is_changed')
+
+    # The triggers outlive the hook, so they aren't registered again for the
+    # next one in the same process.
+    del give
+    gc.collect()
+    with IAF.context():
+        IAF._charm = harness.charm
+        IAF.load()
+        IAF._snapshot_topology()
+        for endpoint_name in IAF._bindings:
+            IAF._manage_automatic_flags(endpoint_name)
+    assert register_trigger.call_count == 3
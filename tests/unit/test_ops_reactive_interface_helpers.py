@@ -0,0 +1,114 @@
+import gc
+from unittest.mock import patch
+
+from ops import Object
+
+
+def test_change_tracker(harness):
+    import ops_reactive_interface_helpers as helpers
+    charm = harness.charm
+
+    class Interface(Object):
+        def __init__(self, charm, relation_name):
+            super().__init__(charm, relation_name)
+            self.changes = helpers.ChangeTracker(charm, relation_name,
+                                                 parent=self)
+
+    give = Interface(charm, 'give')
+    tracker = give.changes
+    assert not tracker.is_changed
+
+    rel_id = harness.add_relation('give', 'other')
+    harness.add_relation_unit(rel_id, 'other/0')
+    harness.add_relation_unit(rel_id, 'other/1')
+    harness.update_relation_data(rel_id, 'other', {'sent': 'foo'})
+    assert tracker.is_changed
+    assert tracker.changes() == [(rel_id, 'other'),
+                                 (rel_id, 'other/0'),
+                                 (rel_id, 'other/1')]
+    tracker.acknowledge()
+    assert not tracker.is_changed
+    assert tracker.changes() == []
+
+    # Only the bags which the relation events say may have changed are
+    # hashed again, and only once.
+    with patch.object(helpers, 'md5', wraps=helpers.md5) as md5:
+        for _ in range(3):
+            assert not tracker.is_changed
+        assert md5.call_count == 0
+        harness.update_relation_data(rel_id, 'other/1', {'a': 'b'})
+        assert tracker.is_changed
+        assert tracker.is_changed
+        assert md5.call_count == 2
+    assert tracker.changes() == [(rel_id, 'other/1')]
+    tracker.acknowledge()
+
+    # Refreshing hashes every bag again.
+    with patch.object(helpers, 'md5', wraps=helpers.md5) as md5:
+        tracker.refresh()
+        assert not tracker.is_changed
+        assert md5.call_count == 3
+
+    harness.remove_relation_unit(rel_id, 'other/0')
+    assert tracker.changes() == [(rel_id, 'other/0')]
+    assert tracker.handle.path == (
+        'CharmBase/Interface[give]/ChangeTracker[give]')
+
+
+def test_change_tracker_across_hooks(harness):
+    import ops_reactive_interface_helpers as helpers
+    charm = harness.charm
+    rel_id = harness.add_relation('give', 'other')
+    harness.add_relation_unit(rel_id, 'other/0')
+    tracker = helpers.ChangeTracker(charm, 'give')
+    tracker.acknowledge()
+    charm.framework.commit()
+
+    # A change which nothing checks for in the hook it happens in is still
+    # seen by the next one.
+    harness.update_relation_data(rel_id, 'other/0', {'a': 'b'})
+    charm.framework.commit()
+    del tracker
+    gc.collect()
+    tracker = helpers.ChangeTracker(charm, 'give')
+    assert tracker.is_changed
+    assert tracker.changes() == [(rel_id, 'other/0')]
+
+
+def test_interface_api(harness):
+    import ops_reactive_interface_helpers as helpers
+    api = helpers.InterfaceAPI(harness.charm, 'give')
+    assert api.relation_count() == 0
+    assert not api.is_created()
+    assert not api.is_joined()
+    assert not api.any_remote_data()
+
+    rel_id = harness.add_relation('give', 'other')
+    harness.add_relation_unit(rel_id, 'other/0')
+    harness.add_relation_unit(rel_id, 'other/1')
+    harness.update_relation_data(harness.add_relation('give', 'third'),
+                                 'third', {'sent': 'bar'})
+    harness.update_relation_data(rel_id, 'other', {'sent': 'foo'})
+    harness.update_relation_data(rel_id, 'other/1', {'address': 'a'})
+
+    # Existence checks stop fetching data once something is found.
+    harness.charm.model.relations._invalidate('give')
+    backend = harness.charm.model._backend
+    with patch.object(backend, 'relation_get',
+                      wraps=backend.relation_get) as relation_get:
+        assert api.any_remote_data('sent')
+        assert relation_get.call_count == 1
+    assert api.relation_count() == 2
+    assert api.unit_count() == 2
+    assert api.is_created()
+    assert api.is_joined()
+    assert sorted(unit.name for _, unit in api.iter_units()) == [
+        'other/0', 'other/1']
+    assert sorted(value for _, _, value
+                  in api.iter_remote_data('sent', units=False)) == [
+        'bar', 'foo']
+    assert [entity.name for _, entity, _
+            in api.iter_remote_data('address')] == ['other/1']
+    assert api.count_remote_data() == 3
+    assert api.count_remote_data('address', apps=False) == 1
+    assert not api.any_remote_data('sent', apps=False)